@@ -0,0 +1,297 @@
+import contextlib
+import io
+import json
+import math
+import os
+import sys
+
+import psycopg2 as psycopg
+import psycopg2.extensions
+
+import main as migrator
+
+# Benchmark of the migrator on synthetic data.
+# Creates a STA 2.1.2 source and a STA 3.1.1 target database on a local PostgreSQL instance, fills the source with
+# synthetic data at every given scale factor, runs the migration and reports the wall time of every stage. The scaling
+# exponent between two scale factors (~1 for linear, ~2 for quadratic stages) exposes algorithmic regressions.
+#
+# Every scale factor is migrated once per COPY format in BENCH_COPY_FORMATS (see `COPY_FORMAT` of the migrator), so
+# text and binary transfers can be compared on the same data.
+#
+# usage: python benchmark.py [scale factor ...]
+
+# maintenance database used to (re)create the benchmark databases
+BENCH_DB = os.getenv("BENCH_DB", "host=localhost dbname=postgres user=postgres password=postgres port=5432")
+BENCH_REPORT = os.getenv("BENCH_REPORT", "benchmark.json")
+BENCH_COPY_FORMATS = os.getenv("BENCH_COPY_FORMATS", os.getenv("COPY_FORMAT", "text")).split(",")
+SOURCE_DB_NAME = "sta_bench_source"
+TARGET_DB_NAME = "sta_bench_target"
+
+# rows per scale factor
+DATASETS = 10
+OBSERVATIONS = 10_000
+LOCATIONS = 100
+FEATURES = 10
+
+## Columns of the tables copied unchanged (by `copy_verbatim` or chunked, like `historical_location`), identical in
+## source and target. Tables of `copy_verbatim` not listed get a generic definition.
+verbatim_columns = {
+    "category": "category_id bigint PRIMARY KEY, identifier text, name text",
+    "format": "format_id bigint PRIMARY KEY, definition text",
+    "historical_location": "historical_location_id bigint PRIMARY KEY, fk_platform_id bigint, time timestamp",
+    "offering": "offering_id bigint PRIMARY KEY, identifier text, name text",
+    "phenomenon": "phenomenon_id bigint PRIMARY KEY, identifier text, name text",
+    "unit": "unit_id bigint PRIMARY KEY, symbol text, name text",
+}
+default_columns = "id bigint PRIMARY KEY, name text"
+
+## STA 2.1.2 source tables not migrated verbatim. `dataset` and `datastream` are read by position.
+source_tables = {
+    "codespace": "codespace_id bigint PRIMARY KEY, name text",
+    "platform": "platform_id bigint PRIMARY KEY, identifier text, sta_identifier text, "
+                "fk_identifier_codespace_id bigint, name text, fk_name_codespace_id bigint, description text, "
+                "properties text",
+    "procedure": "procedure_id bigint PRIMARY KEY, identifier text, sta_identifier text, "
+                 "fk_identifier_codespace_id bigint, name text, fk_name_codespace_id bigint, description text, "
+                 "description_file text, is_reference smallint, fk_type_of_procedure_id bigint, "
+                 "is_aggregation smallint, fk_format_id bigint",
+    "feature": "feature_id bigint PRIMARY KEY, discriminator text, fk_format_id bigint, identifier text, "
+               "sta_identifier text, fk_identifier_codespace_id bigint, name text, fk_name_codespace_id bigint, "
+               "description text, xml text, url text, geom {geometry}",
+    "location": "location_id bigint PRIMARY KEY, identifier text, sta_identifier text, name text, description text, "
+                "location text, geom {geometry}, fk_format_id bigint",
+    "thing_location": "fk_thing_id bigint, fk_location_id bigint",
+    "dataset": "dataset_id bigint PRIMARY KEY, dataset_type text, observation_type text, value_type text, "
+               "fk_procedure_id bigint, fk_phenomenon_id bigint, fk_offering_id bigint, fk_category_id bigint, "
+               "fk_feature_id bigint, fk_platform_id bigint, fk_format_id bigint, fk_unit_id bigint, "
+               "is_deleted smallint, is_disabled smallint, is_published smallint, is_mobile smallint, "
+               "is_insitu smallint, is_hidden smallint, origin_timezone text, first_time timestamp, "
+               "last_time timestamp, first_value numeric, last_value numeric, fk_first_observation_id bigint, "
+               "fk_last_observation_id bigint, decimals integer, identifier text, fk_identifier_codespace_id bigint, "
+               "name text, fk_name_codespace_id bigint, description text, fk_value_profile_id bigint",
+    "datastream": "datastream_id bigint PRIMARY KEY, name text, description text, identifier text, "
+                  "observed_area {geometry}, result_time_start timestamp, result_time_end timestamp, "
+                  "fk_format_id bigint, phenomenon_time_start timestamp, phenomenon_time_end timestamp, "
+                  "fk_unit_id bigint, fk_thing_id bigint, fk_procedure_id bigint, fk_phenomenon_id bigint, "
+                  "sta_identifier text",
+    "datastream_dataset": "fk_datastream_id bigint, fk_dataset_id bigint",
+    "observation": "observation_id bigint PRIMARY KEY, value_type text, fk_dataset_id bigint, "
+                   "sampling_time_start timestamp, sampling_time_end timestamp, result_time timestamp, "
+                   "identifier text, sta_identifier text, fk_identifier_codespace_id bigint, name text, "
+                   "fk_name_codespace_id bigint, description text, is_deleted smallint, valid_time_start timestamp, "
+                   "valid_time_end timestamp, sampling_geometry {geometry}, value_identifier text, value_name text, "
+                   "value_description text, vertical_from numeric, vertical_to numeric, "
+                   "fk_parent_observation_id bigint, value_quantity numeric, value_text text, value_count integer, "
+                   "value_category text, value_boolean smallint, detection_limit_flag smallint, "
+                   "detection_limit numeric, value_reference text, value_geometry {geometry}, value_array text, "
+                   "fk_result_template_id bigint",
+    "parameter": "parameter_id bigint PRIMARY KEY, type text, name text, last_update timestamp, domain text, "
+                 "value_boolean smallint, value_category text, fk_unit_id bigint, value_count integer, "
+                 "value_quantity numeric, value_text text, value_xml text, value_json text",
+    "observation_parameters": "fk_observation_id bigint, fk_parameter_id bigint",
+}
+
+## STA 3.1.1 target tables not migrated verbatim
+target_tables = {
+    "codespace": source_tables["codespace"],
+    "result_template": "result_template_id bigint PRIMARY KEY, identifier text",
+    "platform": "platform_id bigint PRIMARY KEY, identifier text, sta_identifier text, "
+                "fk_identifier_codespace_id bigint, name text, fk_name_codespace_id bigint, description text",
+    "procedure": source_tables["procedure"],
+    "feature": source_tables["feature"],
+    "location": source_tables["location"],
+    "platform_location": "fk_platform_id bigint, fk_location_id bigint REFERENCES location(location_id)",
+    "dataset": "dataset_id bigint PRIMARY KEY, discriminator text, identifier text, sta_identifier text, name text, "
+               "description text, first_time timestamp, last_time timestamp, result_time_start timestamp, "
+               "result_time_end timestamp, observed_area {geometry}, fk_procedure_id bigint, "
+               "fk_phenomenon_id bigint, fk_offering_id bigint, fk_category_id bigint, fk_feature_id bigint, "
+               "fk_platform_id bigint, fk_unit_id bigint, fk_format_id bigint, "
+               "fk_aggregation_id bigint REFERENCES dataset(dataset_id), first_value numeric, last_value numeric, "
+               "fk_first_observation_id bigint, fk_last_observation_id bigint, dataset_type text, "
+               "observation_type text, value_type text, is_deleted smallint, is_disabled smallint, "
+               "is_published smallint, is_mobile smallint, is_insitu smallint, is_hidden smallint, "
+               "origin_timezone text, decimals integer, fk_identifier_codespace_id bigint, "
+               "fk_name_codespace_id bigint, fk_value_profile_id bigint",
+    "observation": source_tables["observation"],
+    "observation_parameter": "parameter_id bigint PRIMARY KEY, type text, name text, description text, "
+                             "last_update timestamp, domain text, "
+                             "fk_observation_id bigint REFERENCES observation(observation_id), "
+                             "fk_parent_parameter_id bigint, value_boolean smallint, value_category text, "
+                             "fk_unit_id bigint, value_count integer, value_quantity numeric, value_text text, "
+                             "value_xml text, value_json text, value_reference text, value_array text",
+}
+
+## Indices and constraints of the target which are dropped and restored during the migration
+target_ddl = [
+    "CREATE INDEX idx_observation_dataset ON observation (fk_dataset_id)",
+    "CREATE INDEX idx_observation_parent ON observation (fk_parent_observation_id)",
+    "CREATE INDEX idx_result_time ON observation (result_time)",
+    "CREATE INDEX idx_sampling_time_start ON observation (sampling_time_start)",
+    "CREATE INDEX idx_sampling_time_end ON observation (sampling_time_end)",
+    "ALTER TABLE observation ADD CONSTRAINT un_observation_identifier UNIQUE (identifier)",
+    "ALTER TABLE observation ADD CONSTRAINT un_observation_staidentifier UNIQUE (sta_identifier)",
+    "ALTER TABLE observation ADD CONSTRAINT un_observation_identity UNIQUE (value_type, fk_dataset_id, "
+    "sampling_time_start, sampling_time_end, result_time, vertical_from, vertical_to)",
+    "ALTER TABLE observation ADD CONSTRAINT fk_dataset FOREIGN KEY (fk_dataset_id) REFERENCES dataset(dataset_id)",
+    "ALTER TABLE observation ADD CONSTRAINT fk_parent_observation FOREIGN KEY (fk_parent_observation_id) "
+    "REFERENCES observation(observation_id)",
+    "ALTER TABLE observation ADD CONSTRAINT fk_data_identifier_codesp FOREIGN KEY (fk_identifier_codespace_id) "
+    "REFERENCES codespace(codespace_id)",
+    "ALTER TABLE observation ADD CONSTRAINT fk_result_template FOREIGN KEY (fk_result_template_id) "
+    "REFERENCES result_template(result_template_id)",
+    "ALTER TABLE dataset ADD CONSTRAINT fk_dataset_first_obs FOREIGN KEY (fk_first_observation_id) "
+    "REFERENCES observation(observation_id)",
+    "ALTER TABLE dataset ADD CONSTRAINT fk_dataset_last_obs FOREIGN KEY (fk_last_observation_id) "
+    "REFERENCES observation(observation_id)",
+]
+
+## Synthetic source data, formatted with the row counts of the scale factor
+source_data = [
+    "INSERT INTO category SELECT 1, 'category', 'category'",
+    "INSERT INTO format SELECT i, 'format' || i FROM generate_series(1, 3) i",
+    "INSERT INTO unit SELECT i, 'u' || i, 'unit' || i FROM generate_series(1, 5) i",
+    "INSERT INTO phenomenon SELECT i, 'phenomenon' || i, 'phenomenon' || i FROM generate_series(1, 10) i",
+    "INSERT INTO procedure SELECT i, 'procedure' || i, 'sta-procedure' || i, NULL, 'procedure' || i, NULL, "
+    "'description', NULL, 0, NULL, 0, 1 FROM generate_series(1, 10) i",
+    "INSERT INTO offering SELECT i, 'procedure' || i, 'offering' || i FROM generate_series(1, 10) i",
+    "INSERT INTO platform SELECT i, 'platform' || i, 'sta-platform' || i, NULL, 'platform' || i, NULL, "
+    "'description', NULL FROM generate_series(1, 10) i",
+    "INSERT INTO feature SELECT i, NULL, 1, 'feature' || i, 'sta-feature' || i, NULL, 'feature' || i, NULL, "
+    "'description', '<feature/>', NULL, {point} FROM generate_series(1, {features}) i",
+    "INSERT INTO location SELECT i, 'location' || i, 'sta-location' || i, 'location' || i, 'description', "
+    "'{{}}', {point}, 1 FROM generate_series(1, {locations}) i",
+    "INSERT INTO historical_location SELECT i, 1 + i % 10, timestamp '2020-01-01' + i * interval '1 minute' "
+    "FROM generate_series(1, {locations}) i",
+    "INSERT INTO thing_location SELECT 1 + i % 10, i FROM generate_series(1, {locations}) i",
+    "INSERT INTO dataset SELECT i, 'timeseries', 'simple', 'quantity', 1 + i % 10, 1 + i % 10, 1 + i % 10, 1, "
+    "1 + i % {features}, 1 + i % 10, 1 + i % 3, 1 + i % 5, 0, 0, 1, 0, 1, 0, 'UTC', timestamp '2020-01-01', "
+    "timestamp '2021-01-01', NULL, NULL, NULL, NULL, 2, 'dataset' || i, NULL, 'dataset' || i, NULL, "
+    "'description', NULL FROM generate_series(1, {datasets}) i",
+    "INSERT INTO datastream SELECT i, 'datastream' || i, 'description', 'datastream' || i, NULL, "
+    "timestamp '2020-01-01', timestamp '2021-01-01', 1 + i % 3, timestamp '2020-01-01', timestamp '2021-01-01', "
+    "1 + i % 5, 1 + i % 10, 1 + i % 10, 1 + i % 10, 'sta-datastream' || i FROM generate_series(1, {datastreams}) i",
+    "INSERT INTO datastream_dataset SELECT 1 + (i - 1) / 2, i FROM generate_series(1, {datasets}) i",
+    "INSERT INTO observation SELECT i, 'quantity', 1 + i % {datasets}, timestamp '2020-01-01' + i * interval '1 s', "
+    "timestamp '2020-01-01' + i * interval '1 s', timestamp '2020-01-01' + i * interval '1 s', "
+    "'observation' || i, 'sta-observation' || i, NULL, NULL, NULL, NULL, 0, NULL, NULL, NULL, NULL, NULL, NULL, "
+    "0, 0, NULL, random() * 100, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL "
+    "FROM generate_series(1, {observations}) i",
+    "INSERT INTO parameter SELECT i, 'quantity', 'parameter' || i, timestamp '2020-01-01', NULL, NULL, NULL, NULL, "
+    "NULL, random(), NULL, NULL, NULL FROM generate_series(1, {parameters}) i",
+    "INSERT INTO observation_parameters SELECT 1 + (i * 10) % {observations}, i "
+    "FROM generate_series(1, {parameters}) i",
+]
+
+
+# (Re)creates database `name` and returns its connection string
+def create_database(name):
+    conn = psycopg.connect(BENCH_DB)
+    conn.set_session(autocommit=True)
+    cursor = conn.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS {name}")
+    cursor.execute(f"CREATE DATABASE {name}")
+    conn.close()
+    return psycopg2.extensions.make_dsn(BENCH_DB, dbname=name)
+
+
+# Creates the given tables and returns the geometry type used (PostGIS `geometry` if available, `text` otherwise)
+def create_schema(dsn, definitions, ddl=()):
+    conn = psycopg.connect(dsn)
+    conn.set_session(autocommit=True)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+        geometry = "geometry"
+    except psycopg.Error:
+        geometry = "text"
+
+    for name in migrator.tables:
+        if migrator.tables[name] is migrator.copy_verbatim or name in verbatim_columns:
+            cursor.execute(f"CREATE TABLE {name} ({verbatim_columns.get(name, default_columns)})")
+    for name, columns in definitions.items():
+        cursor.execute(f"CREATE TABLE {name} ({columns.format(geometry=geometry)})")
+    for statement in ddl:
+        cursor.execute(statement)
+    conn.close()
+    return geometry
+
+
+def create_target(dsn):
+    create_schema(dsn, target_tables, target_ddl)
+    conn = psycopg.connect(dsn)
+    conn.set_session(autocommit=True)
+    for seq in migrator.sequences:
+        conn.cursor().execute(f"CREATE SEQUENCE {seq}_seq")
+    conn.close()
+
+
+# Fills the source database with synthetic data of scale factor `scale`
+def fill_source(dsn, scale, geometry):
+    counts = {
+        "datasets": DATASETS * scale,
+        "datastreams": DATASETS * scale // 2,
+        "observations": OBSERVATIONS * scale,
+        "parameters": OBSERVATIONS * scale // 10,
+        "locations": LOCATIONS * scale,
+        "features": FEATURES * scale,
+        "point": "ST_SetSRID(ST_MakePoint(i % 180, i % 90), 4326)" if geometry == "geometry"
+        else "'POINT(' || i % 180 || ' ' || i % 90 || ')'",
+    }
+    conn = psycopg.connect(dsn)
+    conn.set_session(autocommit=True)
+    for statement in source_data:
+        conn.cursor().execute(statement.format(**counts))
+    conn.cursor().execute("ANALYZE")
+    conn.close()
+    return counts
+
+
+# Runs the migration of scale factor `scale` and returns the wall time of every stage
+def run(scale, copy_format):
+    print(f"preparing scale factor {scale} ({copy_format} COPY)")
+    src = create_database(SOURCE_DB_NAME)
+    target = create_database(TARGET_DB_NAME)
+    geometry = create_schema(src, source_tables)
+    create_target(target)
+    counts = fill_source(src, scale, geometry)
+
+    os.environ.update({"SRC_DB": src, "TARGET_DB": target, "RUN_MODE": "fresh", "REPORT_FILE": "",
+                       "COPY_FORMAT": copy_format})
+    migrator.metrics.clear()
+    migrator.copy_format_cache.clear()
+    print(f"migrating scale factor {scale} ({counts['observations']} observations)")
+    with contextlib.redirect_stdout(io.StringIO()):
+        migrator.main()
+
+    return {f"{record['kind']} {record['name']}": record["seconds"]
+            for record in migrator.metrics if record["kind"] != "chunk"}
+
+
+# Prints the wall time of every stage per scale factor and the scaling exponent between the two largest scales
+def report(scales, results):
+    stages = list(dict.fromkeys(stage for result in results for stage in result))
+    print(f"{'stage':<40}" + "".join(f"{'x' + str(scale):>12}" for scale in scales) + f"{'exponent':>10}")
+    for stage in stages:
+        seconds = [result.get(stage) for result in results]
+        exponent = ""
+        if len(scales) > 1 and seconds[-1] and seconds[-2]:
+            exponent = f"{math.log(seconds[-1] / seconds[-2]) / math.log(scales[-1] / scales[-2]):.2f}"
+        print(f"{stage:<40}" + "".join(f"{s:>12.3f}" if s is not None else f"{'-':>12}" for s in seconds)
+              + f"{exponent:>10}")
+
+
+def main():
+    scales = [int(scale) for scale in sys.argv[1:]] or [1, 4, 16]
+    results = {copy_format: [run(scale, copy_format) for scale in scales] for copy_format in BENCH_COPY_FORMATS}
+    for copy_format, result in results.items():
+        print(f"{copy_format} COPY:")
+        report(scales, result)
+
+    with open(BENCH_REPORT, "w") as f:
+        json.dump([{"scale": scale, "copy_format": copy_format, "seconds": seconds}
+                   for copy_format, result in results.items() for scale, seconds in zip(scales, result)], f, indent=2)
+    print(f"wrote benchmark results to {BENCH_REPORT}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,130 @@
 import os
 import psycopg2 as psycopg
+import collections
+import contextlib
+import datetime
+import gzip
 import io
+import json
+import multiprocessing
+import queue
+import re
 import sys
+import threading
 import time
 import traceback
 import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+
+# metrics of the run (see `measure`)
+metrics = []
+running_phases = []
 
 # database connections
+src_dsn = None
+target_dsn = None
 src_conn = None
 target_conn = None
 
 # debug flag
 DEBUG = False
 
+# streaming flag. If set, source and target COPY run concurrently and are connected by a bounded buffer of
+# STREAM_BUFFER_SIZE bytes instead of buffering every table (chunk) in memory as a whole.
+STREAMING = False
+STREAM_BUFFER_SIZE = 16 * 1024 * 1024
+
+# number of worker processes copying the chunks of chunked tables in parallel. Each worker uses its own pair of
+# connections, all workers read from the same exported snapshot of the source database.
+WORKERS = 1
+
+# run mode: `fresh` truncates the target and starts over, `resume` continues a previous run by skipping the stages and
+# chunks recorded in the journal (or starts the first one), the target is only truncated by `fresh` runs. `auto`
+# resumes if the journal holds an unfinished run and starts fresh otherwise.
+# `delta` only copies the rows created (or changed) since the previous run, identified by the high-water marks
+# (WATERMARKS) recorded by it. MARKS are the high-water marks of the current run, it copies no rows beyond them.
+RUN_MODE = "resume"
+RESUME = False
+DELTA = False
+WATERMARKS = {}
+MARKS = {}
+
+# number of `tables` entries migrated concurrently, each in a worker process with its own connections
+CONCURRENCY = 1
+
+# number of trajectory datasets migrated per statement by `fixup_trajectory_observations`
+FIXUP_BATCH_SIZE = 1_000
+
+# number of indices built (and foreign keys validated) at the same time when restoring deferred indices and
+# constraints, and the `maintenance_work_mem` of their sessions (server default if not set)
+INDEX_WORKERS = 4
+MAINTENANCE_WORK_MEM = None
+
+# format of the COPY transfers: `text`, `binary` or `auto`. Binary COPY saves the conversion of every value to text and
+# back (geometries, timestamps, numerics), but requires the types of the source columns to match the target columns
+# exactly. `auto` uses binary format if they do. Overridden per target table by `COPY_FORMAT_<TABLE>`.
+COPY_FORMAT = "text"
+copy_formats = {}
+
+# execution mode of the transfers: `client` streams the data through the migrator with COPY, `server` runs
+# `INSERT INTO ... SELECT` in the target database against foreign tables of the source (postgres_fdw), keeping the
+# client out of the data path. `auto` uses the server mode if the foreign server can be set up. Overridden per target
+# table by `EXECUTION_MODE_<TABLE>`. FDW_SOURCE is the connection string of the source as seen from the target server
+# (SRC_DB by default). FOREIGN_SOURCE is set if the foreign tables of the source are available.
+EXECUTION_MODE = "client"
+execution_modes = {}
+FDW_SOURCE = None
+FOREIGN_SOURCE = False
+
+# verification (see `verify`): rows per compared chunk, chunks compared at the same time, number of parts a differing
+# chunk is split into, size below which differing rows are listed, number of listed keys per range
+VERIFY_CHUNK_SIZE = 1_000_000
+VERIFY_WORKERS = 4
+VERIFY_SPLIT = 16
+VERIFY_ROWS = 1_000
+VERIFY_KEYS = 20
+
+# extract / load stages (see `extract_main`, `load_main`): DUMP_MODE is `extract` while the source is written to gzip
+# compressed chunk files in DUMP_DIR (compression level DUMP_COMPRESSION) and `load` while the target is loaded from
+# them. The `manifest` lists the steps of every `tables` entry: the files with their target COPY statements and the
+# statements run on the target between them.
+DUMP_MODE = None
+DUMP_DIR = "dump"
+DUMP_COMPRESSION = 1
+manifest = {}
+dump_entry = None
+dump_steps = []
+
+# bulk-load mode: the target tables are UNLOGGED and without foreign keys during the load, the load sessions do not wait
+# for WAL flushes. Integrity is checked in one validation pass at the end (see `begin_bulk_load`).
+BULK_LOAD = False
+
+# JSON report of the run and optional Prometheus textfile with the metrics of the phases
+REPORT_FILE = "report.json"
+PROMETHEUS_FILE = None
+
+# Keyset chunking of large tables, keyed by their name in `tables`. Chunks are ranges of the indexed `key` of the
+# source `table`. `target` is the target table (or `targets` the target tables), which has the same key column.
+# If `defer_ddl` is set, the indices and constraints of the target table are dropped during the copy (see
+# `defer_ddl`). `changed` is the column holding the last modification of a row, used by delta runs. Tables whose rows
+# are edited in place without such a column are `merged` as a whole by delta runs, not only above the watermark.
+# The number of rows per chunk is adjusted to MEMORY_BUDGET (see `ChunkSizer`), unless it is fixed with the
+# `CHUNK_SIZE` environment variable or per table with `CHUNK_SIZE_<NAME>` (e.g. `CHUNK_SIZE_OBSERVATION`).
+chunking = {
+    "observation": {"table": "public.observation", "key": "observation_id", "target": "public.observation",
+                    "defer_ddl": True},
+    "location": {"table": "public.location", "key": "location_id", "target": "public.location"},
+    "parameter": {"table": "public.parameter", "key": "parameter_id", "changed": "last_update"},
+    "feature": {"table": "public.feature", "key": "feature_id", "target": "public.feature", "merged": True},
+    "historical_location": {"table": "public.historical_location", "key": "historical_location_id",
+                            "target": "public.historical_location", "merged": True},
+}
+
+# memory in bytes the chunks of a chunked table may take at the same time (all WORKERS together) and the targeted
+# duration of a chunk in seconds (see `ChunkSizer`)
+MEMORY_BUDGET = 256 * 1024 * 1024
+CHUNK_SECONDS = 30
+
 
 # Clones the given table without any modifications
 def copy_verbatim(name):
@@ -29,270 +141,202 @@ def copy_thing_location(name):
             "COPY public.thing_location(fk_thing_id, fk_location_id) TO STDOUT")
 
 
-# Copies parameters into their respective tables
+# Copies the parameters into the parameter tables of their entities (see `parameter_links`) in a single pass over
+# public.parameter. Every row is tagged with its target table and routed to it (see `fan_out`).
 def copy_parameters(name):
     print(f"copying {name} (this may take a few minutes)")
     src_cursor = src_conn.cursor()
-    target_cursor = target_conn.cursor()
-
-    cfg = {
-        "observation_parameters": {
-            "name": "observation_parameter",
-            "key": "fk_observation_id"
-        }
-    }
-
-    src_cursor.execute(f"SELECT COUNT(*) FROM {name};")
-    total = src_cursor.fetchone()[0]
-
-
-    step_size = 1_000_000
-    for i in range(0, total, step_size):
-        print(f"[{i}/{total}] copying parameters")
-        
-        dump = io.StringIO()
-        stmnt = f"COPY (SELECT parameter_id, type, name, NULL, last_update, domain, {cfg[name]['key']}, " \
-                        " NULL, value_boolean, value_category, fk_unit_id, value_count, value_quantity, " \
-                        " value_text, value_xml, value_json, NULL, NULL " \
-                        f" FROM {name} JOIN parameter on parameter_id = fk_parameter_id ORDER BY parameter_id LIMIT {step_size} OFFSET {i}) TO STDOUT"
-        src_cursor.copy_expert(stmnt, dump)
-        src_conn.commit()
-        dump.seek(0)
-
-        target_cursor.copy_expert(f"COPY public.{cfg[name]['name']} FROM STDIN", dump)
-        target_conn.commit()
-        dump.close()
-
+    links = {}
+    for target, link in parameter_links.items():
+        src_cursor.execute("SELECT to_regclass(%s)", (link["link"],))
+        if src_cursor.fetchone()[0] is None:
+            print(f"skipping {target} ({link['link']} does not exist)")
+        else:
+            links[target] = link
+    src_conn.commit()
+    if not links:
+        return
 
-# Copies Observations in blocks of 100_000 entries.
-# Restores `fk_dataset_first_obs` & `fk_dataset_last_obs` Constraints on public.dataset as they are now fulfilled.
+    union = " UNION ALL ".join(f"SELECT '{target}' AS target, fk_parameter_id, {link['source_key']} AS entity_id "
+                               f"FROM {link['link']}" for target, link in links.items())
+    try:
+        copy_chunked(name,
+                     "SELECT l.target, parameter_id, type, name, NULL AS description, last_update, domain, l.entity_id, "
+                     "NULL AS fk_parent_parameter_id, value_boolean, value_category, fk_unit_id, value_count, "
+                     "value_quantity, value_text, value_xml, value_json, NULL AS value_reference, NULL AS value_array "
+                     f"FROM public.parameter JOIN ({union}) l ON parameter_id = l.fk_parameter_id",
+                     {target: f"COPY public.{target}(parameter_id, type, name, description, last_update, domain, "
+                              f"{link['target_key']}, fk_parent_parameter_id, value_boolean, value_category, "
+                              f"fk_unit_id, value_count, value_quantity, value_text, value_xml, value_json, "
+                              f"value_reference, value_array) FROM STDIN" for target, link in links.items()})
+    finally:
+        close_fan_out_connections()
+
+
+# Columns of public.observation, in the order of the target table
+observation_columns = "observation_id, value_type, fk_dataset_id, sampling_time_start, sampling_time_end, result_time, " \
+                      "identifier, sta_identifier, fk_identifier_codespace_id, name, fk_name_codespace_id, " \
+                      "description, is_deleted, valid_time_start, valid_time_end, sampling_geometry, " \
+                      "value_identifier, value_name, value_description, vertical_from, vertical_to, " \
+                      "fk_parent_observation_id, value_quantity, value_text, value_count, value_category, " \
+                      "value_boolean, detection_limit_flag, detection_limit, value_reference, value_geometry, " \
+                      "value_array, fk_result_template_id"
+
+
+# Copies Observations in keyset chunks (see `chunking`).
+# Indices and constraints of public.observation (and foreign keys referencing it, like `fk_dataset_first_obs` &
+# `fk_dataset_last_obs` on public.dataset) are dropped during the copy and restored afterwards (see `defer_ddl`).
 def copy_observations(name):
     print(f"copying observations (this may take a few minutes)")
-    src_cursor = src_conn.cursor()
-    target_cursor = target_conn.cursor()
-
-    src_cursor.execute("SELECT COUNT(*) FROM public.observation;")
-    total = src_cursor.fetchone()[0]
-
-    # Drop all indices + constraints to speed up insertion
-    target_cursor.execute("DROP INDEX IF EXISTS idx_observation_dataset")
-    target_cursor.execute("DROP INDEX IF EXISTS idx_observation_identifier_codespace")
-    target_cursor.execute("DROP INDEX IF EXISTS idx_observation_is_deleted")
-    target_cursor.execute("DROP INDEX IF EXISTS idx_observation_name_codespace")
-    target_cursor.execute("DROP INDEX IF EXISTS idx_observation_parent")
-    target_cursor.execute("DROP INDEX IF EXISTS idx_observation_result_template")
-    target_cursor.execute("DROP INDEX IF EXISTS idx_observation_staidentifier")
-    target_cursor.execute("DROP INDEX IF EXISTS idx_result_time")
-    target_cursor.execute("DROP INDEX IF EXISTS idx_sampling_time_end")
-    target_cursor.execute("DROP INDEX IF EXISTS idx_sampling_time_start")
-
-    target_cursor.execute("ALTER TABLE public.observation DROP CONSTRAINT IF EXISTS fk_data_identifier_codesp")
-    target_cursor.execute("ALTER TABLE public.observation DROP CONSTRAINT IF EXISTS fk_data_name_codespace")
-    target_cursor.execute("ALTER TABLE public.observation DROP CONSTRAINT IF EXISTS fk_dataset")
-    target_cursor.execute("ALTER TABLE public.observation DROP CONSTRAINT IF EXISTS fk_parent_observation")
-    target_cursor.execute("ALTER TABLE public.observation DROP CONSTRAINT IF EXISTS fk_result_template")
-
-    target_cursor.execute("ALTER TABLE public.observation DROP CONSTRAINT IF EXISTS un_observation_identifier")
-    target_cursor.execute("ALTER TABLE public.observation DROP CONSTRAINT IF EXISTS un_observation_identity")
-    target_cursor.execute("ALTER TABLE public.observation DROP CONSTRAINT IF EXISTS un_observation_staidentifier")
-
-    step_size = 1_000_000
+    if DELTA:
+        # Trajectory observations got ids after the highest observation id of the previous run, move them out of the
+        # way of the observations created since then
+        relocate("public.observation", "observation_id", "value_type = 'trajectory'", WATERMARKS[name][0],
+                 MARKS[name][0], "observation_seq", [("public.observation", "fk_parent_observation_id")])
     try:
-        for i in range(0, total, step_size):
-            print(f"[{i}/{total}] copying observations")
-            dump = io.StringIO()
-
-            src_cursor.copy_expert("COPY (SELECT observation_id, value_type, fk_dataset_id, sampling_time_start, "
-                                   "sampling_time_end, result_time, identifier, sta_identifier, "
-                                   "fk_identifier_codespace_id, name, fk_name_codespace_id, description, is_deleted, "
-                                   "valid_time_start, valid_time_end, sampling_geometry, value_identifier, value_name, "
-                                   "value_description, vertical_from, vertical_to, fk_parent_observation_id, "
-                                   "value_quantity, value_text, value_count, value_category, value_boolean, "
-                                   "detection_limit_flag, detection_limit, value_reference, value_geometry, value_array, "
-                                   "fk_result_template_id FROM public.observation ORDER BY observation_id LIMIT {} OFFSET {}) TO "
-                                   "STDOUT".format(step_size, i), dump)
-            src_conn.commit()
-            dump.seek(0)
-
-            target_cursor.copy_expert("COPY public.observation FROM STDIN", dump)
-            target_conn.commit()
-
-            dump.close()
+        copy_chunked(name, f"SELECT {observation_columns} FROM public.observation", "COPY public.observation FROM STDIN")
     except Exception:
         traceback.print_exc(file=sys.stdout)
         exit(123)
 
-    
-    print("restoring constraints on datasets")
-    # Restore previously dropped constraints on datasets
-    target_cursor.execute(
-        "ALTER TABLE public.dataset ADD CONSTRAINT fk_dataset_first_obs FOREIGN KEY (fk_first_observation_id) "
-        "REFERENCES public.observation (observation_id) MATCH SIMPLE ON UPDATE NO ACTION ON DELETE NO ACTION")
-    target_cursor.execute(
-        "ALTER TABLE public.dataset ADD CONSTRAINT fk_dataset_last_obs FOREIGN KEY (fk_last_observation_id) "
-        "REFERENCES public.observation (observation_id) MATCH SIMPLE ON UPDATE NO ACTION ON DELETE NO ACTION")
-
-    print("restoring constraints on observations (this may take a while)")
-    # Restore indices + constraints on observations
-    target_cursor.execute("ALTER TABLE ONLY public.observation ADD CONSTRAINT un_observation_identifier UNIQUE (identifier);")
-    target_cursor.execute("ALTER TABLE ONLY public.observation ADD CONSTRAINT un_observation_identity UNIQUE (value_type, fk_dataset_id, sampling_time_start, sampling_time_end, result_time, vertical_from, vertical_to);")
-    target_cursor.execute("ALTER TABLE ONLY public.observation ADD CONSTRAINT un_observation_staidentifier UNIQUE (sta_identifier);")
-    target_cursor.execute("ALTER TABLE ONLY public.observation ADD CONSTRAINT fk_data_identifier_codesp FOREIGN KEY (fk_identifier_codespace_id) REFERENCES public.codespace(codespace_id);")
-    target_cursor.execute("ALTER TABLE ONLY public.observation ADD CONSTRAINT fk_data_name_codespace FOREIGN KEY (fk_name_codespace_id) REFERENCES public.codespace(codespace_id);")
-    target_cursor.execute("ALTER TABLE ONLY public.observation ADD CONSTRAINT fk_dataset FOREIGN KEY (fk_dataset_id) REFERENCES public.dataset(dataset_id);")
-    target_cursor.execute("ALTER TABLE ONLY public.observation ADD CONSTRAINT fk_parent_observation FOREIGN KEY (fk_parent_observation_id) REFERENCES public.observation(observation_id);")
-    target_cursor.execute("ALTER TABLE ONLY public.observation ADD CONSTRAINT fk_result_template FOREIGN KEY (fk_result_template_id) REFERENCES public.result_template(result_template_id);")
-
-    print("restoring indices (this may take a while)")
-    print("[1/5] restoring index idx_observation_is_deleted")
-    target_cursor.execute("CREATE INDEX idx_observation_is_deleted ON public.observation USING btree (is_deleted);")
-    print("[2/5] restoring index idx_observation_staidentifier")
-    target_cursor.execute("CREATE INDEX idx_observation_staidentifier ON public.observation USING btree (sta_identifier);")
-    print("[3/5] restoring index idx_result_time")
-    target_cursor.execute("CREATE INDEX idx_result_time ON public.observation USING btree (result_time);")
-    print("[4/5] restoring index idx_sampling_time_end")
-    target_cursor.execute("CREATE INDEX idx_sampling_time_end ON public.observation USING btree (sampling_time_end);")
-    print("[5/5] restoring index idx_sampling_time_start")
-    target_cursor.execute("CREATE INDEX idx_sampling_time_start ON public.observation USING btree (sampling_time_start);")
 
 # Merges public.dataset & public.datastream & public.datastream_dataset into single public.dataset
 # Refactors datastream into aggregate dataset.
-# Drops fk_dataset_first_obs` & `fk_dataset_last_obs` Constraints as they prevent insertion before observations are inserted
+# Drops `fk_dataset_first_obs` & `fk_dataset_last_obs` Constraints as they prevent insertion before observations are inserted.
+# They are deferred together with the other indices and constraints of public.observation.
+# All steps are set-based: datasets and datastreams are copied with `COPY`, sub-datasets are linked by joined UPDATEs.
+# The aggregation id of every datastream is kept in `migrator.datastream_aggregation`, so delta runs can link new
+# datasets to existing aggregations.
 def copy_dataset(name):
     print(f"cloning {name}")
-    src_cursor = src_conn.cursor()
     target_cursor = target_conn.cursor()
 
-    # lift constraints that prevent us from inserting fk_dataset_first_obs
-    target_cursor.execute("ALTER TABLE public.dataset DROP CONSTRAINT IF EXISTS fk_dataset_first_obs")
-    target_cursor.execute("ALTER TABLE public.dataset DROP CONSTRAINT IF EXISTS fk_dataset_last_obs")
-
-    src_cursor.execute("SELECT * FROM public.dataset")
-    datasets = src_cursor.fetchall()
-
-    ## Copy underlying datasets
-    for p in datasets:
-        statement = "INSERT INTO public.dataset(dataset_id, discriminator, identifier, sta_identifier, name, " \
-                    "description, first_time, last_time, result_time_start, result_time_end, observed_area, " \
-                    "fk_procedure_id, fk_phenomenon_id, fk_offering_id, fk_category_id, fk_feature_id, " \
-                    "fk_platform_id, fk_unit_id, fk_format_id, fk_aggregation_id, first_value, last_value, " \
-                    "fk_first_observation_id, fk_last_observation_id, dataset_type, observation_type, value_type, " \
-                    "is_deleted, is_disabled, is_published, is_mobile, is_insitu, is_hidden, origin_timezone, " \
-                    "decimals, fk_identifier_codespace_id, fk_name_codespace_id, fk_value_profile_id) VALUES (%s, %s," \
-                    " %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s," \
-                    " %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s); "
-        target_cursor.execute(statement, (
-            p[0], None, p[26], None, p[28], p[30], p[19], p[20], None, None, None, p[4], p[5], p[6], p[7], p[8], p[9],
-            p[11], p[10], None, p[21], p[22], p[23], p[24], p[1], p[2], p[3], p[12], p[13], p[14], p[15], p[16], p[17],
-            p[18], p[25], p[27], p[29], p[31],))
+    # The source columns are addressed by position
+    p = columns("public.dataset")
+    d = columns("public.datastream")
+
+    if DELTA:
+        # Aggregations got ids after the highest dataset id of the previous run, move them out of the way of the
+        # datasets created since then
+        relocate("public.dataset", "dataset_id", "discriminator = 'aggregation'", WATERMARKS["dataset"][0],
+                 MARKS["dataset"][0], "dataset_seq",
+                 [("public.dataset", "fk_aggregation_id"), ("migrator.datastream_aggregation", "dataset_id")])
+    else:
+        # lift constraints that prevent us from inserting fk_dataset_first_obs
+        defer_ddl("observation", "observation")
+        target_cursor.execute("DELETE FROM migrator.datastream_aggregation")
+
+    ## Copy underlying datasets. Delta runs link the first and last observations after the observations are copied
+    # (see `link_dataset_observations`), the constraints on them are in place.
+    first, last = ("NULL", "NULL") if DELTA else (p[23], p[24])
+    transfer(f"COPY (SELECT {p[0]}, NULL, {p[26]}, NULL, {p[28]}, {p[30]}, {p[19]}, {p[20]}, NULL, NULL, NULL, "
+             f"{p[4]}, {p[5]}, {p[6]}, {p[7]}, {p[8]}, {p[9]}, {p[11]}, {p[10]}, NULL, {p[21]}, {p[22]}, {first}, "
+             f"{last}, {p[1]}, {p[2]}, {p[3]}, {p[12]}, {p[13]}, {p[14]}, {p[15]}, {p[16]}, {p[17]}, {p[18]}, "
+             f"{p[25]}, {p[27]}, {p[29]}, {p[31]} FROM public.dataset "
+             f"{key_range_filter(p[0], None, MARKS['dataset'][0])}) TO STDOUT",
+             "COPY public.dataset(dataset_id, discriminator, identifier, sta_identifier, name, "
+             "description, first_time, last_time, result_time_start, result_time_end, observed_area, "
+             "fk_procedure_id, fk_phenomenon_id, fk_offering_id, fk_category_id, fk_feature_id, "
+             "fk_platform_id, fk_unit_id, fk_format_id, fk_aggregation_id, first_value, last_value, "
+             "fk_first_observation_id, fk_last_observation_id, dataset_type, observation_type, value_type, "
+             "is_deleted, is_disabled, is_published, is_mobile, is_insitu, is_hidden, origin_timezone, "
+             "decimals, fk_identifier_codespace_id, fk_name_codespace_id, fk_value_profile_id) FROM STDIN")
+
+    ## Copy datastreams as aggregations
+    print("aggregating datastreams into datasets")
+    target_cursor.execute("CREATE TEMPORARY TABLE datastream_stage AS SELECT dataset_id AS datastream_id, identifier, "
+                          "sta_identifier, name, description, observed_area, result_time_start, result_time_end, "
+                          "fk_format_id, fk_unit_id, fk_platform_id, fk_procedure_id, fk_phenomenon_id, "
+                          "fk_offering_id FROM public.dataset WITH NO DATA")
+    transfer(f"COPY (SELECT ds.{d[0]}, ds.{d[3]}, ds.{d[14]}, ds.{d[1]}, ds.{d[2]}, ds.{d[4]}, ds.{d[5]}, "
+             f"ds.{d[6]}, ds.{d[7]}, ds.{d[10]}, ds.{d[11]}, ds.{d[12]}, ds.{d[13]}, "
+             f"(SELECT offering_id FROM public.offering WHERE identifier IN ("
+             f"SELECT identifier FROM public.procedure WHERE procedure_id = ds.{d[12]}) LIMIT 1) "
+             f"FROM public.datastream ds {key_range_filter('ds.' + d[0], None, MARKS['datastream'][0])}) TO STDOUT",
+             "COPY datastream_stage FROM STDIN", merge=False)
+
+    # ids of new aggregations are allocated in one pass after the highest dataset id
+    target_cursor.execute("INSERT INTO migrator.datastream_aggregation(datastream_id, dataset_id) "
+                          "SELECT s.datastream_id, m.max_id + row_number() OVER (ORDER BY s.datastream_id) "
+                          "FROM datastream_stage s, (SELECT COALESCE(MAX(dataset_id), 0) AS max_id "
+                          "FROM public.dataset) m WHERE NOT EXISTS (SELECT 1 FROM migrator.datastream_aggregation a "
+                          "WHERE a.datastream_id = s.datastream_id)")
+    target_cursor.execute("INSERT INTO public.dataset(dataset_id, discriminator, identifier, sta_identifier, name, "
+                          "description, observed_area, result_time_start, result_time_end, fk_format_id, fk_unit_id, "
+                          "fk_platform_id, fk_procedure_id, fk_phenomenon_id, fk_offering_id, fk_category_id) "
+                          "SELECT a.dataset_id, 'aggregation', s.identifier, s.sta_identifier, s.name, "
+                          "s.description, s.observed_area, s.result_time_start, s.result_time_end, s.fk_format_id, "
+                          "s.fk_unit_id, s.fk_platform_id, s.fk_procedure_id, s.fk_phenomenon_id, s.fk_offering_id, 1 "
+                          "FROM datastream_stage s JOIN migrator.datastream_aggregation a "
+                          "ON a.datastream_id = s.datastream_id "
+                          "ON CONFLICT (dataset_id) DO UPDATE SET identifier = EXCLUDED.identifier, "
+                          "sta_identifier = EXCLUDED.sta_identifier, name = EXCLUDED.name, "
+                          "description = EXCLUDED.description, observed_area = EXCLUDED.observed_area, "
+                          "result_time_start = EXCLUDED.result_time_start, "
+                          "result_time_end = EXCLUDED.result_time_end, fk_format_id = EXCLUDED.fk_format_id, "
+                          "fk_unit_id = EXCLUDED.fk_unit_id, fk_platform_id = EXCLUDED.fk_platform_id, "
+                          "fk_procedure_id = EXCLUDED.fk_procedure_id, fk_phenomenon_id = EXCLUDED.fk_phenomenon_id, "
+                          "fk_offering_id = EXCLUDED.fk_offering_id")
+
+    # link sub-datasets to aggregations
+    target_cursor.execute("CREATE TEMPORARY TABLE datastream_link (fk_datastream_id bigint, fk_dataset_id bigint)")
+    transfer("COPY (SELECT fk_datastream_id, fk_dataset_id FROM public.datastream_dataset) TO STDOUT",
+             "COPY datastream_link FROM STDIN", merge=False)
+    target_cursor.execute("UPDATE public.dataset d SET fk_aggregation_id = a.dataset_id "
+                          "FROM datastream_link l JOIN migrator.datastream_aggregation a "
+                          "ON a.datastream_id = l.fk_datastream_id WHERE d.dataset_id = l.fk_dataset_id")
+
+    # aggregations share the format of their (first) sub-dataset
+    target_cursor.execute("UPDATE public.dataset d SET fk_format_id = s.fk_format_id "
+                          "FROM (SELECT DISTINCT ON (a.dataset_id) a.dataset_id, sub.fk_format_id "
+                          "FROM datastream_link l JOIN migrator.datastream_aggregation a "
+                          "ON a.datastream_id = l.fk_datastream_id "
+                          "JOIN public.dataset sub ON sub.dataset_id = l.fk_dataset_id "
+                          "ORDER BY a.dataset_id, l.fk_dataset_id) s "
+                          "WHERE d.dataset_id = s.dataset_id")
+    target_cursor.execute("DROP TABLE datastream_stage, datastream_link")
     target_conn.commit()
 
-    src_cursor.execute("SELECT * FROM public.datastream")
-    datastreams = src_cursor.fetchall()
-
-    for d in datastreams:
-
-        # Get offering
-        src_cursor.execute("SELECT offering_id FROM public.offering WHERE identifier IN ("
-                           "SELECT identifier FROM public.procedure where procedure_id = {})".format(d[12]))
-        datasets = src_cursor.fetchone()
-        fk_offering = datasets[0]
-
-        target_cursor.execute("SELECT MAX(dataset_id)+1 FROM public.dataset")
-        datastream_id = target_cursor.fetchone()[0]
-
-        statement = "INSERT INTO public.dataset(dataset_id, discriminator, identifier, sta_identifier, name, " \
-                    "description, observed_area, result_time_start, result_time_end, fk_format_id, fk_unit_id, " \
-                    "fk_platform_id, fk_procedure_id, fk_phenomenon_id, fk_offering_id, fk_category_id) VALUES (" \
-                    "%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s); "
-        target_cursor.execute(statement, (
-            datastream_id, "aggregation", d[3], d[14], d[1], d[2],  d[4], d[5], d[6], d[7], d[10], d[11], d[12], d[13],
-            fk_offering, 1
-        ))
-
-        # link sub-datasets to aggregations
-        # get id of freshly inserted dataset
-        target_cursor.execute("SELECT dataset_id FROM public.dataset WHERE sta_identifier = '{}'".format(d[14]))
-        aggregation_id = target_cursor.fetchone()[0]
-
-        # get all subdatasets
-        src_cursor.execute(
-            "SELECT fk_dataset_id from public.datastream_dataset where fk_datastream_id = {}".format(d[0]))
-        sub_dataset_ids = src_cursor.fetchall()
-
-        if len(sub_dataset_ids) > 0:
-
-            target_cursor.execute(
-                "UPDATE public.dataset SET fk_aggregation_id = {} WHERE dataset_id in ({})".format(
-                    aggregation_id,
-                    ",".join([str(x[0]) for x in sub_dataset_ids]))
-            )
-            target_cursor.execute("UPDATE public.dataset SET fk_format_id = (SELECT fk_format_id FROM public.dataset WHERE dataset_id = '{}') WHERE sta_identifier = '{}'".format(sub_dataset_ids[0][0], d[14]))
-
-        target_conn.commit()
-
 
 # Copies public.platform
 def copy_platform(name):
-    print(f"cloning {name}")
-    dump = io.StringIO()
-    src_cursor = src_conn.cursor()
-    src_cursor.copy_expert(
-        "COPY public.platform(platform_id, identifier, sta_identifier, fk_identifier_codespace_id, name, "
-        "fk_name_codespace_id, description) TO STDOUT".format(
-            name), dump)
-    src_conn.commit()
-    dump.seek(0)
-
-    if DEBUG:
-        print(dump.getvalue())
-
-    target_cursor = target_conn.cursor()
-    target_cursor.copy_expert(
-        "COPY public.platform(platform_id, identifier, sta_identifier, fk_identifier_codespace_id, name, "
-        "fk_name_codespace_id, description) FROM STDIN",
-        dump)
-    target_conn.commit()
+    clone("platform",
+          "platform",
+          "COPY public.platform(platform_id, identifier, sta_identifier, fk_identifier_codespace_id, name, "
+          "fk_name_codespace_id, description) TO STDOUT",
+          "COPY public.platform(platform_id, identifier, sta_identifier, fk_identifier_codespace_id, name, "
+          "fk_name_codespace_id, description) FROM STDIN")
 
     # TODO: Platform->properties
 
 
-
 # Reorder sta_identifier column
 def copy_feature(name):
-    clone("feature",
-          "feature",
-          "COPY public.feature(feature_id, discriminator, fk_format_id, identifier, sta_identifier, "
-          "fk_identifier_codespace_id, name, fk_name_codespace_id, description, xml, url, geom) TO STDOUT")
+    print("cloning features")
+    copy_chunked(name,
+                 "SELECT feature_id, discriminator, fk_format_id, identifier, sta_identifier, "
+                 "fk_identifier_codespace_id, name, fk_name_codespace_id, description, xml, url, geom "
+                 "FROM public.feature",
+                 "COPY public.feature FROM STDIN")
+
+
+# Clones public.historical_location in keyset chunks (see `chunking`)
+def copy_historical_location(name):
+    print("cloning historical locations")
+    copy_chunked(name, "SELECT * FROM public.historical_location", "COPY public.historical_location FROM STDIN")
 
 # Reorder sta_identifier column
 def copy_location(name):
     print("cloning locations (this may take a few minutes)")
-    target_cursor = target_conn.cursor()
-    src_cursor = src_conn.cursor()
-    src_cursor.execute("SELECT COUNT(*) FROM public.location;")
-    total = src_cursor.fetchone()[0]
-    
-    step_size = 1_000_000
     try:
-        for i in range(0, total, step_size):
-            print(f"[{i}/{total}] copying locations")
-            dump = io.StringIO()
-
-            src_cursor.copy_expert("COPY (SELECT location_id, identifier, sta_identifier, name, description, location, "
-                                    "geom, fk_format_id from public.location ORDER BY location_id LIMIT {} OFFSET {}) TO STDOUT"
-                                    .format(step_size, i), dump)
-            src_conn.commit()
-            dump.seek(0)
-
-            target_cursor.copy_expert("COPY public.location FROM STDIN", dump)
-            target_conn.commit()
-
-            dump.close()
+        copy_chunked(name,
+                     "SELECT location_id, identifier, sta_identifier, name, description, location, "
+                     "geom, fk_format_id from public.location",
+                     "COPY public.location FROM STDIN")
     except Exception:
         traceback.print_exc(file=sys.stdout)
         exit(123)
-    
+
 
 # Reorder sta_identifier column
 def copy_procedure(name):
@@ -318,44 +362,1183 @@ def update_sequences():
 # Clones given src_table into target_table. Uses `COPY` semantics for efficiency.
 # Requires both tables to have the same column definitions
 def clone(src_table, target_table, src_copy="COPY {} TO STDOUT", target_copy="COPY {} FROM STDIN"):
-    dump = io.StringIO()
     print(f"cloning {src_table} to {target_table}")
+    transfer(src_copy.format(src_table), target_copy.format(target_table))
+
+
+# Returns the column names of source `table` in their order
+def columns(table):
+    src_cursor = src_conn.cursor()
+    src_cursor.execute(f"SELECT * FROM {table} LIMIT 0")
+    names = [column.name for column in src_cursor.description]
+    src_conn.commit()
+    return names
+
+
+# Bounded in-memory pipe connecting a source `COPY ... TO STDOUT` (writer thread) with a target `COPY ... FROM STDIN`
+# (reader). Data is handed over in blocks of `block_size` bytes, at most `capacity` bytes are buffered at any time.
+class CopyPipe:
+    block_size = 64 * 1024
+
+    def __init__(self, capacity):
+        self.blocks = queue.Queue(maxsize=max(1, capacity // self.block_size))
+        self.pending = []
+        self.pending_size = 0
+        self.size = 0
+        self.remainder = b""
+        self.eof = False
+        self.aborted = False
+        self.error = None
+
+    # Called by the source COPY for every row
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.pending.append(data)
+        self.pending_size += len(data)
+        self.size += len(data)
+        if self.pending_size >= self.block_size:
+            self._flush()
+
+    # Called by the target COPY
+    def read(self, size=-1):
+        while not self.remainder:
+            if self.eof:
+                return b""
+            block = self.blocks.get()
+            if block is None:
+                self.eof = True
+                if self.error is not None:
+                    raise IOError("source copy failed") from self.error
+                return b""
+            self.remainder = block
+        if size is None or size < 0:
+            size = len(self.remainder)
+        data, self.remainder = self.remainder[:size], self.remainder[size:]
+        return data
+
+    # Marks the end of the source data. `error` is re-raised on the reading side.
+    def close(self, error=None):
+        self.error = error
+        try:
+            if error is None:
+                self._flush()
+            self._put(None)
+        except IOError:
+            pass
+
+    # Stops the writer, e.g. after the target COPY failed
+    def abort(self):
+        self.aborted = True
+
+    def _flush(self):
+        if self.pending:
+            self._put(b"".join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def _put(self, block):
+        while True:
+            if self.aborted:
+                raise IOError("target copy aborted")
+            try:
+                self.blocks.put(block, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+
+# Transfers the output of the `src_copy` statement into the target via the `target_copy` statement.
+# Buffers the whole output in memory unless STREAMING is set. Returns the number of rows copied, rows and bytes are
+# accounted to the running phases (see `measure`). In delta runs the rows are merged into the target table unless
+# `merge` is unset (see `merge_into`). The statements are run in the format chosen by `copy_format`, or translated to
+# a statement run by the target server (see `execution_mode`). Extract runs write the rows to a file (see `extract`).
+# A dict of `target_copy` statements by target table fans the rows out to several tables (see `fan_out`).
+def transfer(src_copy, target_copy, merge=True):
+    if isinstance(target_copy, dict):
+        return fan_out(src_copy, target_copy)
+    if DUMP_MODE == "extract":
+        return extract(src_copy, target_copy)
+    if DELTA and merge:
+        return merge_into(src_copy, target_copy)
+    if execution_mode(target_copy) == "server":
+        return transfer_server(src_copy, target_copy)
+
+    src_cursor = src_conn.cursor()
+    target_cursor = target_conn.cursor()
+
+    binary = copy_format(src_copy, target_copy) == "binary"
+    if binary:
+        src_copy += " WITH (FORMAT binary)"
+        target_copy += " WITH (FORMAT binary)"
+
+    if not STREAMING:
+        dump = io.BytesIO()
+        src_cursor.copy_expert(src_copy, dump)
+        src_conn.commit()
+        size = dump.tell()
+        dump.seek(0)
+
+        if DEBUG and not binary:
+            print(dump.getvalue().decode())
+
+        target_cursor.copy_expert(target_copy, dump)
+        target_conn.commit()
+        dump.close()
+        account(target_cursor.rowcount, size)
+        return target_cursor.rowcount
+
+    pipe = CopyPipe(STREAM_BUFFER_SIZE)
+
+    def produce():
+        try:
+            src_cursor.copy_expert(src_copy, pipe)
+            src_conn.commit()
+        except BaseException as e:
+            src_conn.rollback()
+            pipe.close(e)
+            return
+        pipe.close()
+
+    producer = threading.Thread(target=produce, name="copy-producer", daemon=True)
+    producer.start()
+    try:
+        target_cursor.copy_expert(target_copy, pipe, size=CopyPipe.block_size)
+        target_conn.commit()
+    except BaseException:
+        # Errors of the producer after the abort are caused by it, only report a failure of the source itself
+        error = pipe.error
+        pipe.abort()
+        producer.join()
+        if error is not None:
+            raise error
+        raise
+    producer.join()
+    account(target_cursor.rowcount, pipe.size)
+    return target_cursor.rowcount
+
+
+# Splits the text COPY output of a source query into the `pipes` by the value of its first column. The first column
+# is removed from the rows.
+class CopyRouter:
+    def __init__(self, pipes):
+        self.pipes = pipes
+        self.remainder = b""
+
+    # Called by the source COPY for every row
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        lines = (self.remainder + data).split(b"\n")
+        self.remainder = lines.pop()
+        for line in lines:
+            target, _, row = line.partition(b"\t")
+            self.pipes[target].write(row + b"\n")
+
+
+# (Autocommit) target connections of `fan_out` by target table, kept for the following chunks
+fan_out_connections = {}
+
+
+# Closes the `fan_out_connections` at the end of a stage. Worker processes close theirs when they exit.
+def close_fan_out_connections():
+    for conn in fan_out_connections.values():
+        conn.close()
+    fan_out_connections.clear()
+
+
+# Transfers the output of `src_copy`, whose first column names the target table of each row, into the target tables
+# of the `target_copies` statements. The source is read once and the tables are written at the same time, each by a
+# connection of its own. Runs that do not stream into client-side COPY statements (extract, delta and server-side
+# transfers) read the rows of every target table separately instead. Returns the number of rows copied.
+def fan_out(src_copy, target_copies):
+    if DUMP_MODE == "extract" or DELTA or any(execution_mode(copy) == "server" for copy in target_copies.values()):
+        query = source_query(src_copy)
+        src_cursor = src_conn.cursor()
+        src_cursor.execute(f"SELECT * FROM ({query}) q LIMIT 0")
+        column_list = ", ".join(column.name for column in src_cursor.description[1:])
+        return sum(transfer(f"COPY (SELECT {column_list} FROM ({query}) q WHERE q.target = '{target}') TO STDOUT",
+                            target_copy) for target, target_copy in target_copies.items())
+
+    pipes = {target.encode(): CopyPipe(STREAM_BUFFER_SIZE) for target in target_copies}
+
+    def consume(target, target_copy, pipe):
+        if target not in fan_out_connections:
+            fan_out_connections[target] = connect_target()
+        cursor = fan_out_connections[target].cursor()
+        try:
+            cursor.copy_expert(target_copy, pipe, size=CopyPipe.block_size)
+        except BaseException:
+            pipe.abort()
+            raise
+        return cursor.rowcount
+
+    with ThreadPoolExecutor(max_workers=len(pipes), thread_name_prefix="copy-consumer") as executor:
+        futures = [executor.submit(consume, target, target_copy, pipes[target.encode()])
+                   for target, target_copy in target_copies.items()]
+        src_cursor = src_conn.cursor()
+        try:
+            src_cursor.copy_expert(src_copy, CopyRouter(pipes))
+            src_conn.commit()
+        except BaseException as e:
+            src_conn.rollback()
+            for pipe in pipes.values():
+                pipe.close(e)
+            wait(futures)
+            # The failure of a target COPY aborts the source COPY, report the original error
+            for pipe, future in zip(pipes.values(), futures):
+                if pipe.aborted and future.exception() is not None:
+                    raise future.exception()
+            raise
+        for pipe in pipes.values():
+            pipe.close()
+        rows = sum(future.result() for future in futures)
+    account(rows, sum(pipe.size for pipe in pipes.values()))
+    return rows
+
+
+# Measures wall time, rows and bytes of a phase of the migration (kind `phase`, `table`, `chunk`, ...) and adds its
+# record to `metrics`. Transfers are accounted to all phases running in the process.
+@contextlib.contextmanager
+def measure(kind, name, **fields):
+    record = {"kind": kind, "name": name, **fields, "rows": 0, "bytes": 0}
+    started = time.time()
+    running_phases.append(record)
+    try:
+        yield record
+    finally:
+        running_phases.remove(record)
+        record["seconds"] = time.time() - started
+        record["rows_per_second"] = record["rows"] / record["seconds"] if record["seconds"] > 0 else None
+        metrics.append(record)
+
+
+def account(rows, size):
+    for record in running_phases:
+        record["rows"] += rows
+        record["bytes"] += size
+
+
+# Prints the progress of copying `name` with the current throughput and the estimated remaining time
+def progress(name, done, total, started):
+    elapsed = time.time() - started
+    rate = done / elapsed if elapsed > 0 else 0
+    eta = datetime.timedelta(seconds=round((total - done) / rate)) if rate > 0 and total >= done else "unknown"
+    print(f"[{done}/{total}] copying {name} ({rate:.0f} rows/s, ETA {eta})")
+
+
+# Writes the metrics of the run as JSON report to REPORT_FILE and, if PROMETHEUS_FILE is set, the metrics of all
+# phases except the chunks as Prometheus textfile
+def write_report(started):
+    if REPORT_FILE:
+        with open(REPORT_FILE, "w") as f:
+            json.dump({
+                "started": datetime.datetime.fromtimestamp(started, datetime.timezone.utc).isoformat(),
+                "seconds": time.time() - started,
+                "resumed": RESUME,
+                "workers": WORKERS,
+                "concurrency": CONCURRENCY,
+                "phases": metrics,
+            }, f, indent=2, default=str)
+        print(f"wrote report to {REPORT_FILE}")
+
+    if PROMETHEUS_FILE:
+        lines = []
+        for metric, description in [("seconds", "Wall time of a migration phase in seconds"),
+                                    ("rows", "Rows transferred in a migration phase"),
+                                    ("bytes", "Bytes transferred in a migration phase")]:
+            lines.append(f"# HELP sta_migrator_phase_{metric} {description}")
+            lines.append(f"# TYPE sta_migrator_phase_{metric} gauge")
+            for record in metrics:
+                if record["kind"] != "chunk":
+                    lines.append(f'sta_migrator_phase_{metric}{{kind="{record["kind"]}",name="{record["name"]}"}} '
+                                 f'{record[metric]}')
+        # Write atomically, the file may be read by the node exporter at any time
+        with open(PROMETHEUS_FILE + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(PROMETHEUS_FILE + ".tmp", PROMETHEUS_FILE)
+
+
+# Decisions of `copy_format` in `auto` mode, keyed by the target COPY statement
+copy_format_cache = {}
+
+
+# Returns the format of the transfer from `src_copy` to `target_copy`: the COPY_FORMAT of the target table or, in
+# `auto` mode, `binary` if the types of the source projection match the types of the target columns.
+def copy_format(src_copy, target_copy):
+    table, column_list = re.match(r"COPY\s+([\w.]+)\s*(?:\((.*)\))?\s+FROM STDIN", target_copy, re.S).groups()
+    setting = copy_formats.get(table.split(".")[-1], COPY_FORMAT)
+    if setting != "auto":
+        return setting
+    if target_copy not in copy_format_cache:
+        copy_format_cache[target_copy] = "binary" if source_types(src_copy) == target_types(table, column_list) \
+            else "text"
+        if DEBUG:
+            print(f"using {copy_format_cache[target_copy]} format for {table}")
+    return copy_format_cache[target_copy]
+
+
+# Returns the query of source statement `src_copy`
+def source_query(src_copy):
+    query = re.match(r"COPY\s*\((.*)\)\s*TO STDOUT$", src_copy, re.S)
+    if query is not None:
+        return query.group(1)
+    table, column_list = re.match(r"COPY\s+([\w.]+)\s*(?:\((.*)\))?\s+TO STDOUT$", src_copy, re.S).groups()
+    if "." not in table:
+        table = f"public.{table}"
+    return f"SELECT {column_list or '*'} FROM {table}"
 
+
+# Returns the type names of the columns produced by source statement `src_copy`. Runs within the current transaction
+# of the source connection, which may be bound to an exported snapshot.
+def source_types(src_copy):
     src_cursor = src_conn.cursor()
-    src_cursor.copy_expert(src_copy.format(src_table), dump)
+    src_cursor.execute(f"SELECT * FROM ({source_query(src_copy)}) q LIMIT 0")
+    oids = [column.type_code for column in src_cursor.description]
+    src_cursor.execute("SELECT oid, format_type(oid, NULL) FROM pg_type WHERE oid = ANY(%s)", (oids,))
+    names = dict(src_cursor.fetchall())
+    return [names[oid] for oid in oids]
+
+
+# Returns the type names of the `column_list` (all columns if `None`) of target `table`
+def target_types(table, column_list):
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("SELECT attname, format_type(atttypid, NULL) FROM pg_attribute WHERE attrelid = %s::regclass "
+                          "AND attnum > 0 AND NOT attisdropped ORDER BY attnum", (table,))
+    types = target_cursor.fetchall()
+    if column_list is None:
+        return [type_name for _, type_name in types]
+    types = dict(types)
+    return [types[column.strip()] for column in column_list.split(",")]
+
+
+# Returns the execution mode of the transfer to `target_copy`: the EXECUTION_MODE of the target table, `auto` resolves
+# to `server` if the foreign tables of the source are available.
+def execution_mode(target_copy):
+    table = re.match(r"COPY\s+([\w.]+)", target_copy).group(1)
+    setting = execution_modes.get(table.split(".")[-1], EXECUTION_MODE)
+    if setting == "auto":
+        return "server" if FOREIGN_SOURCE else "client"
+    return setting
+
+
+# Runs the transfer from `src_copy` to `target_copy` as `INSERT INTO ... SELECT` in the target database, reading the
+# source tables through their foreign tables in the `migrator_source` schema. Unlike COPY transfers, the foreign
+# tables are read in a transaction of their own, not within an exported snapshot of the source.
+def transfer_server(src_copy, target_copy):
+    table, column_list = re.match(r"COPY\s+([\w.]+)\s*(?:\((.*)\))?\s+FROM STDIN", target_copy, re.S).groups()
+    query = re.sub(r"\bpublic\.", "migrator_source.", source_query(src_copy))
+    target_cursor = target_conn.cursor()
+    target_cursor.execute(f"INSERT INTO {table}" + (f"({column_list}) " if column_list else " ") + query)
+    target_conn.commit()
+    account(target_cursor.rowcount, 0)
+    return target_cursor.rowcount
+
+
+# Sets up the source as foreign server `migrator_source` of the target and imports its public schema into the
+# `migrator_source` schema of the target. Returns whether the foreign tables are available, failures are only raised
+# if the server mode is required.
+def init_foreign_source():
+    if EXECUTION_MODE == "client" and all(mode == "client" for mode in execution_modes.values()):
+        return False
+    options = psycopg.extensions.parse_dsn(FDW_SOURCE or src_dsn)
+    user_options = {key: options.pop(key) for key in ["user", "password"] if key in options}
+    options["fetch_size"] = "10000"
+    target_cursor = target_conn.cursor()
+    try:
+        target_cursor.execute("CREATE EXTENSION IF NOT EXISTS postgres_fdw")
+        target_cursor.execute("DROP SERVER IF EXISTS migrator_source CASCADE")
+        target_cursor.execute("CREATE SERVER migrator_source FOREIGN DATA WRAPPER postgres_fdw OPTIONS ("
+                              + ", ".join(f"{key} %s" for key in options) + ")", list(options.values()))
+        target_cursor.execute("CREATE USER MAPPING FOR CURRENT_USER SERVER migrator_source"
+                              + (" OPTIONS (" + ", ".join(f"{key} %s" for key in user_options) + ")"
+                                 if user_options else ""), list(user_options.values()))
+        target_cursor.execute("DROP SCHEMA IF EXISTS migrator_source CASCADE")
+        target_cursor.execute("CREATE SCHEMA migrator_source")
+        target_cursor.execute("IMPORT FOREIGN SCHEMA public FROM SERVER migrator_source INTO migrator_source")
+        target_conn.commit()
+    except psycopg.Error:
+        target_conn.rollback()
+        if EXECUTION_MODE == "server" or "server" in execution_modes.values():
+            raise
+        traceback.print_exc(file=sys.stdout)
+        print("foreign tables of the source are not available, using client-side COPY")
+        return False
+    print("reading the source through foreign tables of the target")
+    return True
+
+
+# Target of extract runs: records the statements meant for the target database as steps of the manifest, which are
+# run by the load stage
+class ManifestTarget:
+    def cursor(self):
+        return self
+
+    def execute(self, statement, params=None):
+        dump_steps.append({"execute": statement, "params": params})
+
+    def commit(self):
+        pass
+
+
+# Extract runs: writes the output of `src_copy` to the next chunk file of the current `tables` entry and records it
+# together with `target_copy` in the manifest. Returns the number of rows written.
+def extract(src_copy, target_copy):
+    table = re.match(r"COPY\s+([\w.]+)", target_copy).group(1)
+    if copy_formats.get(table.split(".")[-1], COPY_FORMAT) == "binary":
+        src_copy += " WITH (FORMAT binary)"
+        target_copy += " WITH (FORMAT binary)"
+
+    file = f"{dump_entry}/{len(dump_steps):05d}.copy.gz"
+    path = os.path.join(DUMP_DIR, file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    src_cursor = src_conn.cursor()
+    with gzip.open(path + ".tmp", "wb", compresslevel=DUMP_COMPRESSION) as f:
+        src_cursor.copy_expert(src_copy, f)
     src_conn.commit()
-    dump.seek(0)
+    os.replace(path + ".tmp", path)
+
+    size = os.path.getsize(path)
+    dump_steps.append({"copy": target_copy, "file": file, "rows": src_cursor.rowcount, "bytes": size})
+    account(src_cursor.rowcount, size)
+    return src_cursor.rowcount
+
+
+def write_manifest():
+    path = os.path.join(DUMP_DIR, "manifest.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, default=str)
+    os.replace(path + ".tmp", path)
+
+
+# Load runs: runs the manifest steps of `tables` entry `name` against the target
+def load_entry(name):
+    if name not in manifest["entries"]:
+        print(f"skipping {name} (not extracted)")
+        return
+
+    # Consecutive files are loaded together, unless only one of them targets a temporary table
+    batches = []
+    for step in manifest["entries"][name]:
+        if "copy" in step and batches and "copy" in batches[-1][0] \
+                and is_public_copy(batches[-1][0]["copy"]) == is_public_copy(step["copy"]):
+            batches[-1].append(step)
+        else:
+            batches.append([step])
+
+    target_cursor = target_conn.cursor()
+    for batch in batches:
+        step = batch[0]
+        if "copy" in step:
+            load_files(name, batch)
+        elif "execute" in step:
+            target_cursor.execute(step["execute"], step["params"])
+            target_conn.commit()
+        elif "defer_ddl" in step:
+            defer_ddl(*step["defer_ddl"])
+        elif "restore_ddl" in step:
+            with measure("indices", step["restore_ddl"]):
+                restore_ddl(step["restore_ddl"])
+
+
+# Returns whether target COPY statement `target_copy` writes to a public (not temporary) table
+def is_public_copy(target_copy):
+    return "." in re.match(r"COPY\s+([\w.]+)", target_copy).group(1)
 
-    if DEBUG:
-        print(dump.getvalue())
 
+# Loads the chunk files of `steps` into the target. Files of public tables are loaded by WORKERS threads at the same
+# time, each with its own connection, files of temporary tables on the main connection. Chunks journaled by a previous
+# run are skipped, a chunk is journaled once all of its files are loaded.
+def load_files(name, steps):
     target_cursor = target_conn.cursor()
-    target_cursor.copy_expert(target_copy.format(target_table), dump)
+    target_cursor.execute("SELECT lower_bound, upper_bound FROM migrator.journal WHERE stage = %s AND chunk", (name,))
+    journaled = set(target_cursor.fetchall())
+    pending = [step for step in steps if "upper" not in step or (step["lower"], step["upper"]) not in journaled]
+    if RESUME and name in chunking:
+        for lower, upper in {(step["lower"], step["upper"]) for step in pending if "upper" in step}:
+            for table in chunk_targets(name):
+                target_cursor.execute(f"DELETE FROM {table} {key_range_filter(chunking[name]['key'], lower, upper)}")
+
+    def load(step):
+        conn = connect_target() if is_public_copy(step["copy"]) else target_conn
+        try:
+            started = time.time()
+            cursor = conn.cursor()
+            with gzip.open(os.path.join(DUMP_DIR, step["file"]), "rb") as f:
+                cursor.copy_expert(step["copy"], f, size=CopyPipe.block_size)
+            conn.commit()
+            return cursor.rowcount, time.time() - started
+        finally:
+            if conn is not target_conn:
+                conn.close()
+
+    total = sum(step["rows"] for step in pending)
+    copied = 0
+    started = time.time()
+    parallel = is_public_copy(steps[0]["copy"])
+    unloaded = collections.Counter((step["lower"], step["upper"]) for step in pending if "upper" in step)
+    with ThreadPoolExecutor(max_workers=WORKERS if parallel else 1) as executor:
+        futures = {executor.submit(load, step): step for step in pending}
+        for future in as_completed(futures):
+            step = futures[future]
+            rows, seconds = future.result()
+            chunk = {"kind": "chunk", "name": name, "lower": step.get("lower"), "upper": step.get("upper"),
+                     "rows": rows, "bytes": step["bytes"], "seconds": seconds,
+                     "rows_per_second": rows / seconds if seconds > 0 else None}
+            metrics.append(chunk)
+            account(rows, step["bytes"])
+            if "upper" in step:
+                unloaded[step["lower"], step["upper"]] -= 1
+                if unloaded[step["lower"], step["upper"]] == 0:
+                    journal(name, step["lower"], step["upper"], chunk=True)
+            copied += rows
+            progress(name, copied, total, started)
+
+
+# Delta runs: copies the rows into a staging table and merges them into the target table of `target_copy`. Rows are
+# matched by the primary key of the target table and updated, tables without primary key only receive the rows they
+# do not hold yet.
+def merge_into(src_copy, target_copy):
+    table, column_list = re.match(r"COPY\s+([\w.]+)\s*(?:\((.*)\))?\s+FROM STDIN", target_copy, re.S).groups()
+    if "." not in table:
+        table = f"public.{table}"
+    target_cursor = target_conn.cursor()
+    if column_list is None:
+        target_cursor.execute("SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 "
+                              "AND NOT attisdropped ORDER BY attnum", (table,))
+        column_list = ", ".join(row[0] for row in target_cursor.fetchall())
+    names = [column.strip() for column in column_list.split(",")]
+    column_list = ", ".join(names)
+
+    target_cursor.execute("DROP TABLE IF EXISTS delta_stage")
+    target_cursor.execute(f"CREATE TEMPORARY TABLE delta_stage (LIKE {table})")
+    rows = transfer(src_copy, f"COPY delta_stage({column_list}) FROM STDIN", merge=False)
+
+    target_cursor.execute("SELECT a.attname FROM pg_index i JOIN pg_attribute a ON a.attrelid = i.indrelid "
+                          "AND a.attnum = ANY(i.indkey) WHERE i.indrelid = %s::regclass AND i.indisprimary", (table,))
+    key = [row[0] for row in target_cursor.fetchall()]
+    if key:
+        updates = ", ".join(f"{name} = EXCLUDED.{name}" for name in names if name not in key)
+        target_cursor.execute(f"INSERT INTO {table}({column_list}) SELECT {column_list} FROM delta_stage "
+                              f"ON CONFLICT ({', '.join(key)}) DO " + (f"UPDATE SET {updates}" if updates else "NOTHING"))
+    else:
+        target_cursor.execute(f"INSERT INTO {table}({column_list}) SELECT {column_list} FROM delta_stage "
+                              f"EXCEPT SELECT {column_list} FROM {table}")
+    target_cursor.execute("DROP TABLE delta_stage")
+    target_conn.commit()
+    return rows
+
+
+# Moves the rows of target `table` matching `condition` with a `key` above `mark` to new keys drawn from `sequence`
+# above `floor`, so the source rows up to `floor` can be merged without colliding with them. The `references` (table,
+# column) pointing to the moved rows are updated in the same statement.
+def relocate(table, key, condition, mark, floor, sequence, references):
+    target_cursor = target_conn.cursor()
+    target_cursor.execute(f"SELECT setval('{sequence}', GREATEST(%s, (SELECT MAX({key}) FROM {table})))", (floor,))
+    updates = "".join(f", moved_{i} AS (UPDATE {reference} r SET {column} = m.new_id FROM moved m "
+                      f"WHERE r.{column} = m.old_id)" for i, (reference, column) in enumerate(references))
+    target_cursor.execute(f"WITH moved AS (SELECT {key} AS old_id, nextval('{sequence}') AS new_id FROM {table} "
+                          f"WHERE {condition} AND (%s IS NULL OR {key} > %s)){updates} "
+                          f"UPDATE {table} t SET {key} = m.new_id FROM moved m WHERE t.{key} = m.old_id",
+                          (mark, mark))
+    print(f"relocated {target_cursor.rowcount} rows of {table}")
     target_conn.commit()
 
+
+# Builds the WHERE clause restricting `key` to the chunk (lower, upper] and the optional further `conditions`.
+# `None` denotes an open bound.
+def key_range_filter(key, lower, upper, *conditions):
+    conditions = [condition for condition in conditions if condition]
+    if lower is not None:
+        conditions.append(f"{key} > {lower}")
+    if upper is not None:
+        conditions.append(f"{key} <= {upper}")
+    if not conditions:
+        return ""
+    return "WHERE " + " AND ".join(conditions)
+
+
+# Walks the (indexed) `key` of the source `table` and yields (lower, upper) bounds of consecutive chunks holding at
+# most `step_size` rows each, covering the range (lower, until]. Finding the next bound only scans the index entries
+# of the chunk itself, so the cost of a chunk does not depend on its position in the table (unlike LIMIT/OFFSET paging).
+# `step_size` is a number of rows or a `ChunkSizer`, whose current step is read for every chunk.
+def key_ranges(table, key, step_size, lower=None, until=None, conn=None):
+    src_cursor = (conn or src_conn).cursor()
+    while True:
+        step = getattr(step_size, "step", step_size)
+        src_cursor.execute(f"SELECT {key} FROM {table} {key_range_filter(key, lower, until)} "
+                           f"ORDER BY {key} OFFSET {step - 1} LIMIT 1")
+        row = src_cursor.fetchone()
+        upper = row[0] if row is not None else until
+        yield lower, upper
+        if row is None or upper == until:
+            return
+        lower = upper
+
+
+# Number of rows per chunk of chunked table `name`. The first chunk is sized by the average row size of the source
+# table in the catalog, the following chunks by the bytes per row and the throughput of the finished chunks: a chunk
+# takes at most MEMORY_BUDGET / WORKERS bytes and about CHUNK_SECONDS. The step changes by at most a factor of two
+# per chunk. A `step_size` fixed by the configuration is kept.
+class ChunkSizer:
+    min_step = 1_000
+    max_step = 10_000_000
+    default_step = 1_000_000
+
+    def __init__(self, name, conn=None):
+        cfg = chunking[name]
+        self.name = name
+        self.fixed = cfg.get("step_size") is not None
+        self.budget = MEMORY_BUDGET / max(WORKERS, 1)
+        if self.fixed:
+            self.step = cfg["step_size"]
+            return
+
+        cursor = (conn or src_conn).cursor()
+        cursor.execute("SELECT reltuples, pg_table_size(oid) FROM pg_class WHERE oid = %s::regclass", (cfg["table"],))
+        rows, size = cursor.fetchone()
+        # tables never analyzed have no row estimate
+        self.step = self.clamp(self.budget * rows / size if rows > 0 and size > 0 else self.default_step)
+        print(f"chunks of {name}: {self.step} rows (~{rows:.0f} rows, {size} bytes in the source)")
+
+    def clamp(self, step):
+        return int(min(max(step, self.min_step), self.max_step))
+
+    def observe(self, rows, size, seconds):
+        if self.fixed or rows == 0:
+            return
+        step = self.budget * rows / size if size > 0 else self.max_step
+        if seconds > 0:
+            step = min(step, rows / seconds * CHUNK_SECONDS)
+        step = self.clamp(min(max(step, self.step / 2), self.step * 2))
+        if DEBUG and step != self.step:
+            print(f"chunks of {self.name}: {step} rows ({size / rows:.0f} bytes/row"
+                  + (f", {rows / seconds:.0f} rows/s)" if seconds > 0 else ")"))
+        self.step = step
+
+
+# Copies the rows of `select` chunk by chunk into the target using `target_copy`.
+# Chunks are key ranges as configured in `chunking[name]`, `select` must not contain a WHERE clause.
+def copy_chunked(name, select, target_copy):
+    cfg = chunking[name]
+    src_cursor = src_conn.cursor()
+
+    src_cursor.execute(f"SELECT COUNT(*) FROM public.{name};")
+    total = src_cursor.fetchone()[0]
+
+    if cfg.get("defer_ddl") and not DELTA:
+        defer_ddl(name, cfg["target"].split(".")[-1])
+
+    # Only copy the key ranges not journaled by a previous run (or copied by the previous run in delta runs) up to the
+    # high-water mark of the run. Rows of a chunk committed to the target but not to the journal are removed first.
+    mark = MARKS[name][0]
+    if DELTA:
+        gaps = [(None if cfg.get("merged") else WATERMARKS.setdefault(name, (None, None))[0], mark)]
+    elif DUMP_MODE == "extract":
+        gaps = [(None, mark)]
+    else:
+        gaps = [(lower, upper if upper is not None else mark) for lower, upper in pending_ranges(name)]
+    if RESUME:
+        target_cursor = target_conn.cursor()
+        for lower, upper in gaps:
+            for table in chunk_targets(name):
+                target_cursor.execute(f"DELETE FROM {table} {key_range_filter(cfg['key'], lower, upper)}")
+
+    if WORKERS > 1 and DUMP_MODE != "extract":
+        copy_chunked_parallel(name, select, target_copy, total, gaps)
+    else:
+        copied = 0
+        started = time.time()
+        sizer = ChunkSizer(name)
+        for gap_lower, gap_upper in gaps:
+            for lower, upper in key_ranges(cfg["table"], cfg["key"], sizer, gap_lower, gap_upper):
+                progress(name, copied, total, started)
+                with measure("chunk", name, lower=lower, upper=upper) as chunk:
+                    copied += transfer(chunk_copy(name, select, lower, upper), target_copy)
+                sizer.observe(chunk["rows"], chunk["bytes"], chunk["seconds"])
+                journal(name, lower, upper, chunk=True)
+        progress(name, copied, total, started)
+
+    # Rows changed since the previous run
+    changed = cfg.get("changed")
+    if DELTA and changed and WATERMARKS[name][1] is not None:
+        print(f"copying rows of {name} changed since {WATERMARKS[name][1]}")
+        src_cursor = src_conn.cursor()
+        condition = src_cursor.mogrify(f"WHERE {changed} > %s AND {cfg['key']} <= %s",
+                                       (WATERMARKS[name][1], WATERMARKS[name][0])).decode()
+        src_conn.commit()
+        transfer(f"COPY ({select} {condition}) TO STDOUT", target_copy)
+
+    if cfg.get("defer_ddl") and not DELTA:
+        with measure("indices", name):
+            restore_ddl(name)
+
+
+# Returns the target tables of chunked table `name`
+def chunk_targets(name):
+    if name in targets:
+        return [f"public.{table}" for table in targets[name]]
+    return [chunking[name]["target"]]
+
+
+# Builds the source COPY statement of the chunk (lower, upper] of chunked table `name`
+def chunk_copy(name, select, lower, upper):
+    key = chunking[name]["key"]
+    return f"COPY ({select} {key_range_filter(key, lower, upper)} ORDER BY {key}) TO STDOUT"
+
+
+# Copies the chunks of chunked table `name` with WORKERS worker processes.
+# The chunk bounds are computed lazily, as workers become free, within a source transaction whose snapshot is
+# exported to the workers, so the result is the same as the one of a serial copy.
+def copy_chunked_parallel(name, select, target_copy, total, gaps):
+    cfg = chunking[name]
+    exporter = psycopg.connect(src_dsn)
+    try:
+        exporter.set_session(isolation_level=psycopg.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+        cursor = exporter.cursor()
+        cursor.execute("SELECT pg_export_snapshot()")
+        snapshot = cursor.fetchone()[0]
+        # Chunks are cut when a worker is about to become free, so they follow the sizes observed so far
+        sizer = ChunkSizer(name, exporter)
+        chunks = (chunk for lower, until in gaps
+                  for chunk in key_ranges(cfg["table"], cfg["key"], sizer, lower, until, exporter))
+        print(f"copying {name} with {WORKERS} workers")
+
+        copied = 0
+        started = time.time()
+        with ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_worker, initargs=(src_dsn, target_dsn, worker_state())) as executor:
+            futures = {}
+            try:
+                while True:
+                    while len(futures) <= WORKERS:
+                        bounds = next(chunks, None)
+                        if bounds is None:
+                            break
+                        futures[executor.submit(copy_chunk, name, select, target_copy, snapshot, *bounds)] = bounds
+                    if not futures:
+                        break
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        bounds = futures.pop(future)
+                        chunk = future.result()
+                        metrics.append(chunk)
+                        account(chunk["rows"], chunk["bytes"])
+                        sizer.observe(chunk["rows"], chunk["bytes"], chunk["seconds"])
+                        copied += chunk["rows"]
+                        journal(name, *bounds, chunk=True)
+                        progress(name, copied, total, started)
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                raise
+        exporter.commit()
+    finally:
+        exporter.close()
+
+
+# Returns the state of the run handed over to worker processes
+def worker_state():
+    return {"resume": RESUME, "delta": DELTA, "watermarks": WATERMARKS, "marks": MARKS,
+            "foreign_source": FOREIGN_SOURCE, "dump_mode": DUMP_MODE, "manifest": manifest}
+
+
+# Initializes a worker process with its own pair of database connections and the `state` of the run
+def init_worker(src, target, state):
+    global src_dsn, target_dsn, src_conn, target_conn, RESUME, DELTA, WATERMARKS, MARKS, FOREIGN_SOURCE, DUMP_MODE
+    global manifest
+    configure()
+    src_dsn = src
+    target_dsn = target
+    RESUME = state["resume"]
+    DELTA = state["delta"]
+    WATERMARKS = state["watermarks"]
+    MARKS = state["marks"]
+    FOREIGN_SOURCE = state["foreign_source"]
+    DUMP_MODE = state["dump_mode"]
+    manifest = state["manifest"]
+    target_conn = connect_target()
+    # The load stage runs without source
+    if src is not None:
+        src_conn = psycopg.connect(src)
+        src_conn.set_session(isolation_level=psycopg.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+
+
+# Opens an additional (autocommit) connection to the target database
+def connect_target():
+    conn = psycopg.connect(target_dsn)
+    conn.set_session(autocommit=True)
+    tune_session(conn)
+    return conn
+
+
+# Load sessions of bulk-load runs do not wait for their commits to be flushed to disk. A crash loses the last commits,
+# which are not journaled either and copied again on resume. The UNLOGGED tables themselves are emptied by the crash
+# recovery though, such runs cannot be resumed (see `check_bulk_load`).
+def tune_session(conn):
+    if BULK_LOAD:
+        conn.cursor().execute("SET synchronous_commit = off")
+
+
+# Copies the chunk (lower, upper] of chunked table `name` within the exported source `snapshot`. Runs in a worker.
+# Returns the metrics of the chunk.
+def copy_chunk(name, select, target_copy, snapshot, lower, upper):
+    with measure("chunk", name, lower=lower, upper=upper) as chunk:
+        src_conn.cursor().execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+        try:
+            transfer(chunk_copy(name, select, lower, upper), target_copy)
+        finally:
+            # Server-side transfers do not read from the source connection, the snapshot of the next chunk needs a
+            # new transaction
+            src_conn.rollback()
+    metrics.remove(chunk)
+    return chunk
+
+
+# Creates a trajectory observation as parent of the quantity observations of every dataset without discriminator.
+# Datasets are migrated in batches of FIXUP_BATCH_SIZE, each batch is a single statement inserting the parent
+# observations, re-parenting the quantity observations joined on the returned ids and journaling the batch.
 def fixup_trajectory_observations():
     print("migrating trajectory observations")
     target_cursor = target_conn.cursor()
 
-    target_cursor.execute("SELECT dataset_id from public.dataset where discriminator is null;")
-    dataset_ids = target_cursor.fetchall()
-    count = 0
-    for id in dataset_ids:
-        print(f"[{count} / {len(dataset_ids)}] migrating dataset {id[0]}")
-        identifier = str(uuid.uuid4())
+    # Skip datasets migrated by a previous run
+    target_cursor.execute("SELECT MAX(upper_bound) FROM migrator.journal WHERE stage = 'trajectory' AND chunk")
+    migrated = target_cursor.fetchone()[0]
+    target_cursor.execute("SELECT dataset_id from public.dataset where discriminator is null AND dataset_id > %s "
+                          "ORDER BY dataset_id;", (migrated if migrated is not None else -1,))
+    dataset_ids = [row[0] for row in target_cursor.fetchall()]
+    for i in range(0, len(dataset_ids), FIXUP_BATCH_SIZE):
+        batch = dataset_ids[i:i + FIXUP_BATCH_SIZE]
+        print(f"[{i} / {len(dataset_ids)}] migrating datasets {batch[0]} to {batch[-1]}")
+        identifiers = [str(uuid.uuid4()) for _ in batch]
+
+        target_cursor.execute(
+            "WITH trajectory AS (INSERT INTO public.observation(observation_id, value_type, fk_dataset_id, "
+            "sampling_time_start, sampling_time_end, result_time, identifier, sta_identifier, "
+            "fk_identifier_codespace_id, name, fk_name_codespace_id, description, is_deleted, valid_time_start, "
+            "valid_time_end, sampling_geometry, value_identifier, value_name, value_description, vertical_from, "
+            "vertical_to, fk_parent_observation_id, value_quantity, value_text, value_count, value_category, "
+            "value_boolean, detection_limit_flag, detection_limit, value_reference, value_geometry, value_array, "
+            "fk_result_template_id) "
+            "SELECT nextval('observation_seq'), 'trajectory', t.dataset_id, '1970-01-01 00:00:01', "
+            "'1970-01-01 00:00:01', null, t.identifier, t.identifier, null, null, null, null, 0, null, null, null, "
+            "null, null, null, 0, 0, null, null, null, null, null, null, null, null, null, null, null, null "
+            "FROM unnest(%s::bigint[], %s::text[]) AS t(dataset_id, identifier) "
+            "RETURNING observation_id, fk_dataset_id), "
+            "batch AS (INSERT INTO migrator.journal(stage, chunk, lower_bound, upper_bound) "
+            "VALUES ('trajectory', true, %s, %s)) "
+            "UPDATE public.observation o SET fk_parent_observation_id = trajectory.observation_id FROM trajectory "
+            "WHERE o.fk_dataset_id = trajectory.fk_dataset_id AND o.value_type = 'quantity'",
+            (batch, identifiers, batch[0], batch[-1]))
+        target_conn.commit()
+        # the migrated datasets are the rows of this phase
+        account(len(batch), 0)
+    print(f"[{len(dataset_ids)} / {len(dataset_ids)}] migrated trajectory observations")
+
+    if DELTA:
+        # New quantity observations of trajectory datasets migrated before
+        mark = WATERMARKS.get("observation", (None, None))[0]
+        target_cursor.execute("UPDATE public.observation o SET fk_parent_observation_id = t.observation_id "
+                              "FROM public.observation t WHERE t.fk_dataset_id = o.fk_dataset_id "
+                              "AND t.value_type = 'trajectory' AND o.value_type = 'quantity' "
+                              "AND (%s IS NULL OR o.observation_id > %s)", (mark, mark))
+        target_conn.commit()
 
-        insert = f"INSERT INTO public.observation(observation_id, value_type, fk_dataset_id, sampling_time_start, sampling_time_end, result_time, identifier, sta_identifier, fk_identifier_codespace_id, name, fk_name_codespace_id, description, is_deleted, valid_time_start, valid_time_end, sampling_geometry, value_identifier, value_name, value_description, vertical_from, vertical_to, fk_parent_observation_id, value_quantity, value_text, value_count, value_category, value_boolean, detection_limit_flag, detection_limit, value_reference, value_geometry, value_array, fk_result_template_id) VALUES (nextval('observation_seq'), 'trajectory', {id[0]}, '1970-01-01 00:00:01', '1970-01-01 00:00:01', null, '{identifier}', '{identifier}', null, null, null, null, 0, null, null, null, null, null, null, 0, 0, null, null, null, null, null, null, null, null, null, null, null, null);"
-        target_cursor.execute(insert)
-        
-        target_cursor.execute("SELECT MAX(observation_id) FROM public.observation;")
-        trajectory_obs_id = target_cursor.fetchone()[0]
-        
-        update = f"UPDATE public.observation SET fk_parent_observation_id={trajectory_obs_id} where fk_dataset_id={id[0]} and value_type='quantity'"
-        target_cursor.execute(update)
 
-        target_conn.commit()
-        
-        count += 1
+# Delta runs: links the datasets to their first and last observations, which may have been copied by this run
+def link_dataset_observations():
+    p = columns("public.dataset")
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("CREATE TEMPORARY TABLE dataset_observation_link (dataset_id bigint, "
+                          "fk_first_observation_id bigint, fk_last_observation_id bigint)")
+    transfer(f"COPY (SELECT {p[0]}, {p[23]}, {p[24]} FROM public.dataset "
+             f"{key_range_filter(p[0], None, MARKS['dataset'][0])}) TO STDOUT",
+             "COPY dataset_observation_link FROM STDIN", merge=False)
+    target_cursor.execute("UPDATE public.dataset d SET fk_first_observation_id = l.fk_first_observation_id, "
+                          "fk_last_observation_id = l.fk_last_observation_id FROM dataset_observation_link l "
+                          "WHERE d.dataset_id = l.dataset_id")
+    target_cursor.execute("DROP TABLE dataset_observation_link")
+    target_conn.commit()
+
+
+# Creates the journal recording finished stages (`tables` entries, ...) and the committed chunks of chunked stages,
+# the table keeping the definitions of dropped indices and constraints until they are restored, the aggregation ids of
+# the datastreams and the high-water marks of the last finished run.
+# They live in their own schema so they are not affected by `truncate_tables`.
+def init_journal():
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("CREATE SCHEMA IF NOT EXISTS migrator")
+    target_cursor.execute("CREATE TABLE IF NOT EXISTS migrator.journal (stage text NOT NULL, chunk boolean NOT NULL, "
+                          "lower_bound bigint, upper_bound bigint, finished timestamptz NOT NULL DEFAULT now())")
+    target_cursor.execute("CREATE TABLE IF NOT EXISTS migrator.deferred_ddl (owner text NOT NULL, kind text NOT NULL, "
+                          "table_name text NOT NULL, name text NOT NULL, index_name text, definition text NOT NULL, "
+                          "PRIMARY KEY (owner, table_name, name))")
+    target_cursor.execute("CREATE TABLE IF NOT EXISTS migrator.datastream_aggregation (datastream_id bigint PRIMARY KEY, "
+                          "dataset_id bigint NOT NULL)")
+    target_cursor.execute("CREATE TABLE IF NOT EXISTS migrator.watermark (stage text PRIMARY KEY, key_max bigint, "
+                          "last_update timestamp)")
+    target_conn.commit()
+
+
+# Records a finished stage or, if `chunk` is set, a committed chunk (lower, upper] of a stage.
+# Delta runs are not journaled, they can simply be repeated. Extract runs have no journal.
+def journal(stage, lower=None, upper=None, chunk=False):
+    if DELTA:
+        return
+    if DUMP_MODE == "extract":
+        # The bounds of a chunk are kept with the steps of its files, the load stage journals it
+        if chunk:
+            for step in reversed(dump_steps):
+                if "copy" not in step or "upper" in step:
+                    break
+                step.update(lower=lower, upper=upper)
+        return
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("INSERT INTO migrator.journal(stage, chunk, lower_bound, upper_bound) VALUES (%s, %s, %s, %s)",
+                          (stage, chunk, lower, upper))
+    target_conn.commit()
+
+
+# Reads the current high-water marks of the source: the highest key (and last update) of every chunked table and the
+# highest dataset and datastream ids
+def source_watermarks():
+    src_cursor = src_conn.cursor()
+    marks = {}
+    for name, cfg in chunking.items():
+        changed = f"MAX({cfg['changed']})" if cfg.get("changed") else "NULL"
+        src_cursor.execute(f"SELECT MAX({cfg['key']}), {changed} FROM {cfg['table']}")
+        marks[name] = src_cursor.fetchone()
+    for name in ["dataset", "datastream"]:
+        src_cursor.execute(f"SELECT MAX({columns(f'public.{name}')[0]}), NULL FROM public.{name}")
+        marks[name] = src_cursor.fetchone()
+    src_conn.commit()
+    return marks
+
+
+def load_watermarks():
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("SELECT stage, key_max, last_update FROM migrator.watermark")
+    return {stage: (key_max, last_update) for stage, key_max, last_update in target_cursor.fetchall()}
+
+
+def record_watermarks(marks):
+    target_cursor = target_conn.cursor()
+    for stage, (key_max, last_update) in marks.items():
+        target_cursor.execute("INSERT INTO migrator.watermark(stage, key_max, last_update) VALUES (%s, %s, %s) "
+                              "ON CONFLICT (stage) DO UPDATE SET key_max = EXCLUDED.key_max, "
+                              "last_update = EXCLUDED.last_update", (stage, key_max, last_update))
+    target_conn.commit()
+
+
+# Checks whether the journal holds a run which has not been finished
+def has_unfinished_run():
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("SELECT EXISTS(SELECT 1 FROM migrator.journal), "
+                          "EXISTS(SELECT 1 FROM migrator.journal WHERE stage = 'migration' AND NOT chunk)")
+    started, finished = target_cursor.fetchone()
+    return started and not finished
+
+
+def is_finished(stage):
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("SELECT EXISTS(SELECT 1 FROM migrator.journal WHERE stage = %s AND NOT chunk)", (stage,))
+    return target_cursor.fetchone()[0]
+
+
+# Returns the key ranges of chunked stage `name` not covered by the chunks in the journal
+def pending_ranges(name):
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("SELECT lower_bound, upper_bound FROM migrator.journal WHERE stage = %s AND chunk "
+                          "ORDER BY lower_bound NULLS FIRST", (name,))
+    gaps = []
+    position = None
+    for lower, upper in target_cursor.fetchall():
+        if lower != position:
+            gaps.append((position, lower))
+        if upper is None:
+            return gaps
+        position = upper
+    gaps.append((position, None))
+    return gaps
+
+
+# Drops the indices and constraints of public.`table` and the foreign keys referencing it to speed up bulk loading.
+# Their definitions are read from the catalog and kept in `migrator.deferred_ddl` until `restore_ddl(owner)` recreates
+# them, so they survive an interrupted run. Primary keys are kept.
+def defer_ddl(owner, table):
+    if DUMP_MODE == "extract":
+        dump_steps.append({"defer_ddl": [owner, table]})
+        return
+    print(f"dropping indices and constraints of {table}")
+    target_cursor = target_conn.cursor()
+
+    target_cursor.execute("SELECT DISTINCT c.conname, format('%%I.%%I', n.nspname, t.relname), "
+                          "pg_get_constraintdef(c.oid) FROM pg_constraint c "
+                          "JOIN pg_class t ON t.oid = c.conrelid JOIN pg_namespace n ON n.oid = t.relnamespace "
+                          "WHERE c.contype = 'f' AND (c.conrelid = %s::regclass OR c.confrelid = %s::regclass)",
+                          (f"public.{table}", f"public.{table}"))
+    foreign_keys = target_cursor.fetchall()
+    target_cursor.execute("SELECT ic.relname, pg_get_indexdef(i.indexrelid), c.conname FROM pg_index i "
+                          "JOIN pg_class ic ON ic.oid = i.indexrelid "
+                          "LEFT JOIN pg_constraint c ON c.conindid = i.indexrelid AND c.conrelid = i.indrelid "
+                          "AND c.contype IN ('p', 'u', 'x') "
+                          "WHERE i.indrelid = %s::regclass AND (c.contype IS NULL OR c.contype = 'u')",
+                          (f"public.{table}",))
+    indices = target_cursor.fetchall()
+
+    # Record all definitions before dropping anything
+    statement = "INSERT INTO migrator.deferred_ddl(owner, kind, table_name, name, index_name, definition) " \
+                "VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING"
+    for name, table_name, definition in foreign_keys:
+        target_cursor.execute(statement, (owner, "foreign_key", table_name, name, None, definition))
+    for index_name, definition, constraint in indices:
+        if constraint is None:
+            target_cursor.execute(statement, (owner, "index", f"public.{table}", index_name, index_name, definition))
+        else:
+            target_cursor.execute(statement, (owner, "unique", f"public.{table}", constraint, index_name, definition))
+
+    for name, table_name, _ in foreign_keys:
+        target_cursor.execute(f"ALTER TABLE {table_name} DROP CONSTRAINT IF EXISTS {name}")
+    for index_name, _, constraint in indices:
+        if constraint is None:
+            target_cursor.execute(f"DROP INDEX IF EXISTS public.{index_name}")
+        else:
+            target_cursor.execute(f"ALTER TABLE public.{table} DROP CONSTRAINT IF EXISTS {constraint}")
+    target_conn.commit()
+
+
+# Restores the indices and constraints deferred by `owner`. Indices are built at the same time on INDEX_WORKERS
+# separate connections. Unique constraints are attached to their rebuilt indices, unlogged tables are switched back to
+# LOGGED, foreign keys are added `NOT VALID` and validated concurrently afterwards.
+def restore_ddl(owner):
+    if DUMP_MODE == "extract":
+        dump_steps.append({"restore_ddl": owner})
+        return
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("SELECT kind, table_name, name, index_name, definition FROM migrator.deferred_ddl "
+                          "WHERE owner = %s ORDER BY kind, table_name, name", (owner,))
+    deferred = target_cursor.fetchall()
+    indices = [d for d in deferred if d[0] in ("index", "unique")]
+    unique_constraints = [d for d in deferred if d[0] == "unique"]
+    logged = [d for d in deferred if d[0] == "logged"]
+    foreign_keys = [d for d in deferred if d[0] == "foreign_key"]
+
+    print(f"restoring {len(indices)} indices of {owner} (this may take a while)")
+    run_ddl(owner, [(kind, table_name, name,
+                     re.sub(r"^CREATE (UNIQUE )?INDEX ", r"CREATE \1INDEX IF NOT EXISTS ", definition))
+                    for kind, table_name, name, _, definition in indices])
+
+    print(f"restoring {len(unique_constraints)} unique constraints of {owner}")
+    for _, table_name, name, index_name, _ in unique_constraints:
+        if not constraint_exists(table_name, name):
+            target_cursor.execute(f"ALTER TABLE {table_name} ADD CONSTRAINT {name} UNIQUE USING INDEX {index_name}")
+        forget_ddl(target_cursor, owner, table_name, name)
+
+    # Foreign keys require both tables to be logged
+    print(f"switching {len(logged)} tables of {owner} to LOGGED")
+    run_ddl(owner, [(kind, table_name, name, definition) for kind, table_name, name, _, definition in logged])
+
+    print(f"restoring {len(foreign_keys)} foreign keys of {owner}")
+    for _, table_name, name, _, definition in foreign_keys:
+        if not constraint_exists(table_name, name):
+            definition = re.sub(r" NOT VALID$", "", definition)
+            target_cursor.execute(f"ALTER TABLE {table_name} ADD CONSTRAINT {name} {definition} NOT VALID")
+    run_ddl(owner, [(kind, table_name, name, f"ALTER TABLE {table_name} VALIDATE CONSTRAINT {name}")
+                    for kind, table_name, name, _, _ in foreign_keys])
+    target_conn.commit()
+
+
+# Runs the given (kind, table_name, name, statement) DDL statements on INDEX_WORKERS separate connections.
+# Finished statements are removed from `migrator.deferred_ddl`, except for unique constraints, which are still pending.
+def run_ddl(owner, statements):
+    def execute(kind, table_name, name, statement):
+        conn = connect_target()
+        try:
+            cursor = conn.cursor()
+            if MAINTENANCE_WORK_MEM is not None:
+                cursor.execute("SET maintenance_work_mem = %s", (MAINTENANCE_WORK_MEM,))
+            cursor.execute(statement)
+            if kind != "unique":
+                forget_ddl(cursor, owner, table_name, name)
+        finally:
+            conn.close()
+        return name
+
+    with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as executor:
+        futures = [executor.submit(execute, *statement) for statement in statements]
+        for i, future in enumerate(as_completed(futures)):
+            print(f"[{i + 1}/{len(statements)}] restored {future.result()}")
+
+
+def forget_ddl(cursor, owner, table_name, name):
+    cursor.execute("DELETE FROM migrator.deferred_ddl WHERE owner = %s AND table_name = %s AND name = %s",
+                   (owner, table_name, name))
+
+
+def constraint_exists(table_name, name):
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("SELECT EXISTS(SELECT 1 FROM pg_constraint WHERE conrelid = %s::regclass AND conname = %s)",
+                          (table_name, name))
+    return target_cursor.fetchone()[0]
+
+
+# Prepares the target for bulk loading: all foreign keys of the public tables are dropped (recorded in
+# `migrator.deferred_ddl` like the indices of deferred tables) and the tables are switched to UNLOGGED, so the load
+# neither checks references row by row nor writes WAL. Safe to repeat when resuming.
+def begin_bulk_load():
+    print("preparing target for bulk load")
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("SELECT c.conname, format('%I.%I', n.nspname, t.relname), pg_get_constraintdef(c.oid) "
+                          "FROM pg_constraint c JOIN pg_class t ON t.oid = c.conrelid "
+                          "JOIN pg_namespace n ON n.oid = t.relnamespace "
+                          "WHERE c.contype = 'f' AND n.nspname = 'public'")
+    foreign_keys = target_cursor.fetchall()
+    target_cursor.execute("SELECT format('%I.%I', n.nspname, c.relname) FROM pg_class c "
+                          "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                          "WHERE n.nspname = 'public' AND c.relkind = 'r' AND c.relpersistence = 'p'")
+    logged = [row[0] for row in target_cursor.fetchall()]
+
+    statement = "INSERT INTO migrator.deferred_ddl(owner, kind, table_name, name, index_name, definition) " \
+                "VALUES ('bulk_load', %s, %s, %s, NULL, %s) ON CONFLICT DO NOTHING"
+    for name, table_name, definition in foreign_keys:
+        target_cursor.execute(statement, ("foreign_key", table_name, name, definition))
+    for table_name in logged:
+        target_cursor.execute(statement, ("logged", table_name, table_name, f"ALTER TABLE {table_name} SET LOGGED"))
+
+    for name, table_name, _ in foreign_keys:
+        target_cursor.execute(f"ALTER TABLE {table_name} DROP CONSTRAINT IF EXISTS {name}")
+    for table_name in logged:
+        target_cursor.execute(f"ALTER TABLE {table_name} SET UNLOGGED")
+    target_conn.commit()
+    journal("bulk_load")
+    print(f"dropped {len(foreign_keys)} foreign keys, switched {len(logged)} tables to UNLOGGED")
+
+
+# Refuses to resume a bulk load interrupted by a restart of the target server: the recovery empties the tables that
+# are still UNLOGGED, while the journal lists their rows as copied.
+def check_bulk_load():
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("SELECT MIN(finished) < pg_postmaster_start_time() FROM migrator.journal "
+                          "WHERE stage = 'bulk_load' AND NOT chunk AND EXISTS(SELECT 1 FROM migrator.deferred_ddl "
+                          "WHERE owner = 'bulk_load' AND kind = 'logged')")
+    if target_cursor.fetchone()[0]:
+        raise ValueError("the target server was restarted during the bulk load, which empties its UNLOGGED tables; "
+                         "start over with RUN_MODE=fresh")
+
+
+# Ends the bulk load: switches the tables back to LOGGED, validates all foreign keys in one pass and freezes and
+# analyzes the loaded tables.
+def finish_bulk_load():
+    with measure("indices", "bulk_load"):
+        restore_ddl("bulk_load")
+
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("SELECT format('%I.%I', n.nspname, c.relname) FROM pg_class c "
+                          "JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = 'public' AND c.relkind = 'r'")
+    print("vacuuming target tables")
+    run_ddl("bulk_load", [("vacuum", table_name, table_name, f"VACUUM (FREEZE, ANALYZE) {table_name}")
+                          for table_name, in target_cursor.fetchall()])
+
 
 # Truncates all tables in target_db.
 def truncate_tables():
@@ -380,7 +1563,7 @@ tables = {
     "dataset_reference": copy_verbatim,
     "feature": copy_feature,
     "feature_hierarchy": copy_verbatim,
-    "historical_location": copy_verbatim,
+    "historical_location": copy_historical_location,
     "location": copy_location,
     "location_historical_location": copy_verbatim,
     "location_i18n": copy_verbatim,
@@ -412,13 +1595,11 @@ tables = {
     "observation": copy_observations,
 
     "dataset_i18n": None,
-    "dataset_parameter": None,
     "datastream": None,
     "datastream_dataset": None,
     "datastream_i18n": None,
-    "parameter": None,
+    "parameter": copy_parameters,
 
-    "procedure_parameter": None,
     "result_template": None,
     "tag": None,
     "tag_dataset": None,
@@ -427,15 +1608,97 @@ tables = {
 
     "platform_location": copy_thing_location,
     "thing_location": copy_thing_location,
+}
+
+## Parameter tables of the target filled by `copy_parameters`: the source table linking the parameters to their
+## entity (`link`), its entity column (`source_key`), the entity column of the target table (`target_key`) and the
+## `tables` entry migrating the entity
+parameter_links = {
+    "observation_parameter": {"link": "public.observation_parameters", "source_key": "fk_observation_id",
+                              "target_key": "fk_observation_id", "entity": "observation"},
+    "dataset_parameter": {"link": "public.dataset_parameters", "source_key": "fk_dataset_id",
+                          "target_key": "fk_dataset_id", "entity": "dataset"},
+    "platform_parameter": {"link": "public.thing_parameters", "source_key": "fk_thing_id",
+                           "target_key": "fk_platform_id", "entity": "platform"},
+    "feature_parameter": {"link": "public.feature_parameters", "source_key": "fk_feature_id",
+                          "target_key": "fk_feature_id", "entity": "feature"},
+    "location_parameter": {"link": "public.location_parameters", "source_key": "fk_location_id",
+                           "target_key": "fk_location_id", "entity": "location"},
+    "phenomenon_parameter": {"link": "public.phenomenon_parameters", "source_key": "fk_phenomenon_id",
+                             "target_key": "fk_phenomenon_id", "entity": "phenomenon"},
+    "procedure_parameter": {"link": "public.procedure_parameters", "source_key": "fk_procedure_id",
+                            "target_key": "fk_procedure_id", "entity": "procedure"},
+}
+
+## Target tables written by the `tables` entries whose target differs from their name
+targets = {
+    "platform_location": [],
+    "thing_location": ["platform_location"],
+    "parameter": list(parameter_links),
+}
 
-    "observation_parameters": None,
-    "platform_parameter": None,
-    "feature_parameter": None,
-    "location_parameter": None,
-    "observation_parameter": None,
-    "phenomenon_parameter": None,
+## Dependencies between `tables` entries which are not (always) expressed by foreign keys in the target,
+## e.g. because the constraints are dropped while the entry is migrated
+dependencies = {
+    "observation": ["dataset"],
+    "parameter": [link["entity"] for link in parameter_links.values()],
 }
 
+## How the rows of the source map onto the target, used by `verify`. Every entry compares the `source_columns` of the
+## source relation `source` with the `target_columns` of the target relation `target`, position by position. Rows are
+## matched by `key` (or `source_key` and `target_key`), entries without key are compared as a whole. `{p[i]}` denotes
+## the i-th column of the source table. Columns set by later steps (trajectory parents, aggregation links and formats)
+## and rows created by the migration are left out. Verbatim copies (`copy_verbatim`, `copy_feature`,
+## `copy_procedure`, `copy_historical_location`) compare all columns of the target table by name.
+projections = {
+    "location": {"source": "public.location", "target": "public.location", "key": "location_id",
+                 "source_columns": "location_id, identifier, sta_identifier, name, description, location, geom, "
+                                   "fk_format_id"},
+    "platform": {"source": "public.platform", "target": "public.platform", "key": "platform_id",
+                 "source_columns": "platform_id, identifier, sta_identifier, fk_identifier_codespace_id, name, "
+                                   "fk_name_codespace_id, description",
+                 "target_columns": "platform_id, identifier, sta_identifier, fk_identifier_codespace_id, name, "
+                                   "fk_name_codespace_id, description"},
+    "thing_location": {"source": "public.thing_location", "target": "public.platform_location",
+                       "source_columns": "fk_thing_id, fk_location_id"},
+    "dataset": {"source": "public.dataset", "target": "public.dataset", "source_key": "{p[0]}",
+                "target_key": "dataset_id", "target_filter": "discriminator IS DISTINCT FROM 'aggregation'",
+                "source_columns": "{p[0]}, {p[26]}, {p[28]}, {p[30]}, {p[19]}, {p[20]}, {p[4]}, {p[5]}, {p[6]}, "
+                                  "{p[7]}, {p[8]}, {p[9]}, {p[11]}, {p[10]}, {p[21]}, {p[22]}, {p[23]}, {p[24]}, "
+                                  "{p[1]}, {p[2]}, {p[3]}, {p[12]}, {p[13]}, {p[14]}, {p[15]}, {p[16]}, {p[17]}, "
+                                  "{p[18]}, {p[25]}, {p[27]}, {p[29]}, {p[31]}",
+                "target_columns": "dataset_id, identifier, name, description, first_time, last_time, "
+                                  "fk_procedure_id, fk_phenomenon_id, fk_offering_id, fk_category_id, fk_feature_id, "
+                                  "fk_platform_id, fk_unit_id, fk_format_id, first_value, last_value, "
+                                  "fk_first_observation_id, fk_last_observation_id, dataset_type, observation_type, "
+                                  "value_type, is_deleted, is_disabled, is_published, is_mobile, is_insitu, "
+                                  "is_hidden, origin_timezone, decimals, fk_identifier_codespace_id, "
+                                  "fk_name_codespace_id, fk_value_profile_id"},
+    "datastream": {"source": "public.datastream",
+                   "target": "public.dataset t JOIN migrator.datastream_aggregation a ON a.dataset_id = t.dataset_id",
+                   "source_key": "{p[0]}", "target_key": "a.datastream_id",
+                   "source_columns": "{p[3]}, {p[14]}, {p[1]}, {p[2]}, {p[4]}, {p[5]}, {p[6]}, {p[10]}, {p[11]}, "
+                                     "{p[12]}, {p[13]}",
+                   "target_columns": "identifier, sta_identifier, name, description, observed_area, "
+                                     "result_time_start, result_time_end, fk_unit_id, fk_platform_id, "
+                                     "fk_procedure_id, fk_phenomenon_id"},
+    "observation": {"source": "public.observation", "target": "public.observation", "key": "observation_id",
+                    "target_filter": "value_type <> 'trajectory'",
+                    "source_columns": observation_columns.replace("fk_parent_observation_id", "NULL"),
+                    "target_columns": observation_columns.replace("fk_parent_observation_id", "NULL")},
+}
+projections.update({
+    target: {"source": f"public.parameter JOIN {link['link']} ON parameter_id = fk_parameter_id",
+             "target": f"public.{target}", "key": "parameter_id",
+             "source_columns": f"parameter_id, type, name, last_update, domain, {link['source_key']}, value_boolean, "
+                               f"value_category, fk_unit_id, value_count, value_quantity, value_text, value_xml, "
+                               f"value_json",
+             "target_columns": f"parameter_id, type, name, last_update, domain, {link['target_key']}, value_boolean, "
+                               f"value_category, fk_unit_id, value_count, value_quantity, value_text, value_xml, "
+                               f"value_json"}
+    for target, link in parameter_links.items()
+})
+
 sequences = [
     "category",
     "codespace",
@@ -453,44 +1716,542 @@ sequences = [
 ]
 
 
-def main():
-    global DEBUG
+# Builds the migration plan: maps every `tables` entry to be migrated onto the entries it depends on.
+# Dependencies are derived from the foreign keys between the target tables and from the declared `dependencies`.
+# Foreign keys pointing to later entries are ignored: those constraints are lifted by the entries themselves (e.g.
+# `copy_dataset`), which also keeps the plan free of cycles.
+def build_plan():
+    jobs = [name for name in tables if tables[name] is not None]
+    position = {name: i for i, name in enumerate(jobs)}
+    owners = {}
+    for name in jobs:
+        for table in targets.get(name, [name]):
+            owners[table] = name
+
+    plan = {name: set(dependencies.get(name, [])) for name in jobs}
+    target_cursor = target_conn.cursor()
+    target_cursor.execute("SELECT src.relname, ref.relname FROM pg_constraint c "
+                          "JOIN pg_class src ON src.oid = c.conrelid "
+                          "JOIN pg_class ref ON ref.oid = c.confrelid "
+                          "JOIN pg_namespace n ON n.oid = c.connamespace "
+                          "WHERE c.contype = 'f' AND n.nspname = 'public'")
+    for table, referenced in target_cursor.fetchall():
+        job = owners.get(table)
+        dependency = owners.get(referenced)
+        if job is not None and dependency is not None and position[dependency] < position[job]:
+            plan[job].add(dependency)
+    return plan
+
+
+# Migrates the `tables` entries of the `plan`. With CONCURRENCY > 1 independent entries are migrated at the same time
+# by a pool of worker processes, an entry is started as soon as all entries it depends on are finished.
+def run_plan(plan):
+    for name in tables:
+        if tables[name] is None:
+            print("ignoring {}".format(name))
+
+    if CONCURRENCY <= 1:
+        for name in plan:
+            run_job(name)
+        return
+
+    pending = dict(plan)
+    running = {}
+    finished = set()
+    with ProcessPoolExecutor(max_workers=CONCURRENCY, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker, initargs=(src_dsn, target_dsn, worker_state())) as executor:
+        try:
+            while pending or running:
+                for name in [name for name in pending if pending[name] <= finished]:
+                    del pending[name]
+                    running[executor.submit(run_worker_job, name)] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    metrics.extend(future.result())
+                    finished.add(name)
+                    print(f"[{len(finished)}/{len(plan)}] finished {name}")
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+
+
+# Migrates a single `tables` entry and records it in the journal.
+# Entries finished by a previous run are skipped, partial results of unfinished (unchunked) entries are removed.
+def run_job(name):
+    if not DELTA and is_finished(name):
+        print("skipping {} (finished by previous run)".format(name))
+        return
+    if RESUME and name not in chunking:
+        target_cursor = target_conn.cursor()
+        for table in targets.get(name, [name]):
+            target_cursor.execute(f"DELETE FROM public.{table}")
+
+    print("processing {}".format(name))
+    with measure("table", name):
+        if DUMP_MODE == "load":
+            load_entry(name)
+        else:
+            tables[name](name)
+    journal(name)
+
+
+# Migrates a single `tables` entry in a worker process and hands its metrics over to the scheduler
+def run_worker_job(name):
+    run_job(name)
+    records = list(metrics)
+    metrics.clear()
+    return records
+
+
+# Returns the `projections` of the given `tables` entries (all migrated entries if empty), completed by the verbatim
+# copies and the source column names. Entries without projection of their own are verified by the projections of
+# their target tables.
+def verify_projections(names):
+    target_cursor = target_conn.cursor()
+    result = {}
+    names = [table for name in names or [name for name in tables if tables[name] is not None]
+             for table in ([table for table in targets[name] if table in projections]
+                           if name not in projections and targets.get(name) else [name])]
+    src_cursor = src_conn.cursor()
+    for name in names:
+        if name in parameter_links:
+            # Parameter tables without link table in the source are not migrated (see `copy_parameters`)
+            src_cursor.execute("SELECT to_regclass(%s)", (parameter_links[name]["link"],))
+            if src_cursor.fetchone()[0] is None:
+                print(f"skipping {name} ({parameter_links[name]['link']} does not exist)")
+                continue
+        if name in projections:
+            projection = dict(projections[name])
+        elif tables.get(name) in (copy_verbatim, copy_feature, copy_procedure, copy_historical_location):
+            # Same table, same column names
+            target_cursor.execute("SELECT a.attname FROM pg_index i JOIN pg_attribute a ON a.attrelid = i.indrelid "
+                                  "AND a.attnum = ANY(i.indkey) WHERE i.indrelid = %s::regclass AND i.indisprimary",
+                                  (f"public.{name}",))
+            key = [row[0] for row in target_cursor.fetchall()]
+            target_cursor.execute("SELECT string_agg(attname, ', ' ORDER BY attnum) FROM pg_attribute "
+                                  "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped",
+                                  (f"public.{name}",))
+            projection = {"source": f"public.{name}", "target": f"public.{name}",
+                          "source_columns": target_cursor.fetchone()[0], "key": key[0] if len(key) == 1 else None}
+        else:
+            print(f"skipping {name} (no projection)")
+            continue
+
+        projection.setdefault("source_key", projection.get("key"))
+        projection.setdefault("target_key", projection.get("key"))
+        projection.setdefault("target_columns", projection["source_columns"])
+        if "{p[" in projection["source_columns"] + (projection["source_key"] or ""):
+            p = columns(projection["source"].split()[0])
+            projection["source_columns"] = projection["source_columns"].format(p=p)
+            projection["source_key"] = projection["source_key"].format(p=p)
+        result[name] = projection
+    src_conn.commit()
+    target_conn.commit()
+    return result
+
+
+# Connections of the verification threads
+verify_connections = threading.local()
+
+
+# Runs `query` on the source or target connection of the current thread and returns the first row
+def verify_query(side, query):
+    conn = getattr(verify_connections, side, None)
+    if conn is None:
+        conn = psycopg.connect(src_dsn if side == "source" else target_dsn)
+        conn.set_session(autocommit=True, readonly=side == "source")
+        setattr(verify_connections, side, conn)
+    cursor = conn.cursor()
+    cursor.execute(query)
+    return cursor.fetchall()
+
+
+# Builds the query computing the row count and an order-independent hash of the rows of `side` within the key range
+# (lower, upper]. The hash is the sum of the first 64 bits of the md5 of every row, computed by the server.
+def verify_hash_query(projection, side, lower, upper):
+    return f"SELECT COUNT(*), COALESCE(SUM(('x' || substr(md5(ROW({projection[side + '_columns']})::text), 1, 16))" \
+           f"::bit(64)::bigint), 0) FROM {projection[side]} {verify_filter(projection, side, lower, upper)}"
+
+
+def verify_filter(projection, side, lower, upper):
+    return key_range_filter(projection[side + "_key"], lower, upper, projection.get(side + "_filter"))
+
+
+# Compares the source and target rows of `projection` within (lower, upper]. Source and target are hashed at the same
+# time by the `queries` pool. Returns the (lower, upper, source count, target count) of the ranges that differ.
+def verify_range(queries, projection, lower, upper):
+    source = queries.submit(verify_query, "source", verify_hash_query(projection, "source", lower, upper))
+    target = queries.submit(verify_query, "target", verify_hash_query(projection, "target", lower, upper))
+    (source_count, source_hash), = source.result()
+    (target_count, target_hash), = target.result()
+    if (source_count, source_hash) == (target_count, target_hash):
+        return []
+    return [(lower, upper, source_count, target_count)]
+
+
+# Drills down into the differing range (lower, upper] of `projection`: ranges of more than VERIFY_ROWS rows are split
+# into VERIFY_SPLIT parts which are compared again, the keys of the differing rows of smaller ranges are returned.
+def drill_down(pools, projection, lower, upper, rows):
+    if projection["source_key"] is None:
+        return []
+    if rows > VERIFY_ROWS:
+        step = max(VERIFY_ROWS, -(-rows // VERIFY_SPLIT))
+        ranges = list(key_ranges(projection["source"], projection["source_key"], step, lower, upper))
+        if len(ranges) > 1:
+            ranges_pool, queries = pools
+            futures = [ranges_pool.submit(verify_range, queries, projection, l, u) for l, u in ranges]
+            keys = []
+            for future in futures:
+                for l, u, source_count, target_count in future.result():
+                    keys += drill_down(pools, projection, l, u, max(source_count, target_count))
+            return keys
+
+    rows = {}
+    for side in ["source", "target"]:
+        for key, digest in verify_query(side, f"SELECT {projection[side + '_key']}, "
+                                              f"md5(ROW({projection[side + '_columns']})::text) "
+                                              f"FROM {projection[side]} {verify_filter(projection, side, lower, upper)}"):
+            rows.setdefault(key, {})[side] = digest
+    return sorted(key for key, digests in rows.items() if digests.get("source") != digests.get("target"))
+
+
+# Verifies the target against the source: compares row counts and hashes of the mapped columns (see `projections`)
+# chunk by chunk and drills down into the chunks that differ. VERIFY_WORKERS chunks are compared at the same time.
+# Returns whether all rows match.
+def verify(names):
+    matching = True
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as ranges_pool, \
+            ThreadPoolExecutor(max_workers=VERIFY_WORKERS * 2) as queries:
+        for name, projection in verify_projections(names).items():
+            with measure("verify", name):
+                if projection["source_key"] is not None:
+                    ranges = key_ranges(projection["source"], projection["source_key"], VERIFY_CHUNK_SIZE)
+                else:
+                    ranges = [(None, None)]
+                try:
+                    futures = [ranges_pool.submit(verify_range, queries, projection, lower, upper)
+                               for lower, upper in ranges]
+                    differing = [d for future in futures for d in future.result()]
+                except psycopg.Error as e:
+                    src_conn.rollback()
+                    print(f"{name}: verification failed: {e}")
+                    matching = False
+                    continue
+                if not differing:
+                    print(f"{name}: ok")
+                    continue
+
+                matching = False
+                for lower, upper, source_count, target_count in differing:
+                    print(f"{name}: ({lower}, {upper}] differs: {source_count} source rows, {target_count} target rows")
+                    keys = drill_down((ranges_pool, queries), projection, lower, upper, max(source_count, target_count))
+                    if keys:
+                        print(f"{name}: {len(keys)} differing rows, keys {keys[:VERIFY_KEYS]}"
+                              + (" ..." if len(keys) > VERIFY_KEYS else ""))
+    return matching
+
+
+# Reads the configuration from the environment
+def configure():
+    global DEBUG, STREAMING, STREAM_BUFFER_SIZE, WORKERS, CONCURRENCY, FIXUP_BATCH_SIZE, RUN_MODE
+    global INDEX_WORKERS, MAINTENANCE_WORK_MEM, REPORT_FILE, PROMETHEUS_FILE, BULK_LOAD, COPY_FORMAT
+    global EXECUTION_MODE, FDW_SOURCE, VERIFY_CHUNK_SIZE, VERIFY_WORKERS, DUMP_DIR, DUMP_COMPRESSION
+    global MEMORY_BUDGET, CHUNK_SECONDS
 
-    src = os.getenv("SRC_DB", "host=localhost, dbname=sws user=postgres password=postgres port=5001")
-    target = os.getenv("TARGET_DB", "host=localhost, dbname=latest user=postgres password=postgres port=5001")
     DEBUG = os.getenv("debug", "") != ""
+    STREAMING = os.getenv("STREAMING", "") != ""
+    STREAM_BUFFER_SIZE = int(os.getenv("STREAM_BUFFER_SIZE", STREAM_BUFFER_SIZE))
+    WORKERS = int(os.getenv("WORKERS", WORKERS))
+    CONCURRENCY = int(os.getenv("CONCURRENCY", CONCURRENCY))
+    FIXUP_BATCH_SIZE = int(os.getenv("FIXUP_BATCH_SIZE", FIXUP_BATCH_SIZE))
+    INDEX_WORKERS = int(os.getenv("INDEX_WORKERS", INDEX_WORKERS))
+    MAINTENANCE_WORK_MEM = os.getenv("MAINTENANCE_WORK_MEM", MAINTENANCE_WORK_MEM)
+    BULK_LOAD = os.getenv("BULK_LOAD", "") != ""
+    COPY_FORMAT = os.getenv("COPY_FORMAT", COPY_FORMAT)
+    for variable, value in os.environ.items():
+        if variable.startswith("COPY_FORMAT_"):
+            copy_formats[variable[len("COPY_FORMAT_"):].lower()] = value
+    for value in [COPY_FORMAT, *copy_formats.values()]:
+        if value not in ("text", "binary", "auto"):
+            raise ValueError(f"invalid COPY_FORMAT: {value}")
+    EXECUTION_MODE = os.getenv("EXECUTION_MODE", EXECUTION_MODE)
+    for variable, value in os.environ.items():
+        if variable.startswith("EXECUTION_MODE_"):
+            execution_modes[variable[len("EXECUTION_MODE_"):].lower()] = value
+    for value in [EXECUTION_MODE, *execution_modes.values()]:
+        if value not in ("client", "server", "auto"):
+            raise ValueError(f"invalid EXECUTION_MODE: {value}")
+    FDW_SOURCE = os.getenv("FDW_SOURCE", FDW_SOURCE)
+    VERIFY_CHUNK_SIZE = int(os.getenv("VERIFY_CHUNK_SIZE", VERIFY_CHUNK_SIZE))
+    VERIFY_WORKERS = int(os.getenv("VERIFY_WORKERS", VERIFY_WORKERS))
+    DUMP_DIR = os.getenv("DUMP_DIR", DUMP_DIR)
+    DUMP_COMPRESSION = int(os.getenv("DUMP_COMPRESSION", DUMP_COMPRESSION))
+    REPORT_FILE = os.getenv("REPORT_FILE", REPORT_FILE)
+    PROMETHEUS_FILE = os.getenv("PROMETHEUS_FILE", PROMETHEUS_FILE)
+    RUN_MODE = os.getenv("RUN_MODE", RUN_MODE)
+    if RUN_MODE not in ("auto", "fresh", "resume", "delta"):
+        raise ValueError(f"invalid RUN_MODE: {RUN_MODE}")
+    for name, cfg in chunking.items():
+        step_size = os.getenv(f"CHUNK_SIZE_{name.upper()}", os.getenv("CHUNK_SIZE"))
+        cfg["step_size"] = int(step_size) if step_size else None
+    MEMORY_BUDGET = int(os.getenv("MEMORY_BUDGET", MEMORY_BUDGET))
+    CHUNK_SECONDS = float(os.getenv("CHUNK_SECONDS", CHUNK_SECONDS))
+
+
+# Reads the connection strings of the source and target database from the environment
+def configure_dsns():
+    global src_dsn, target_dsn
+    src_dsn = os.getenv("SRC_DB", "host=localhost, dbname=sws user=postgres password=postgres port=5001")
+    target_dsn = os.getenv("TARGET_DB", "host=localhost, dbname=latest user=postgres password=postgres port=5001")
+
+
+def main():
+    global src_dsn, RESUME, DELTA, WATERMARKS, MARKS, FOREIGN_SOURCE
+
+    configure_dsns()
+    configure()
+    if DUMP_MODE == "load":
+        src_dsn = None
 
-    # Connect to databases
-    with psycopg.connect(src) as s, psycopg.connect(target) as t:
+    # Connect to databases (the load stage reads the source from the extracted files). The connections are closed
+    # at the end, so the databases can be dropped by the caller (see benchmark.py).
+    with contextlib.closing(psycopg.connect(src_dsn)) if src_dsn else contextlib.nullcontext() as s, \
+            contextlib.closing(psycopg.connect(target_dsn)) as t:
         global src_conn, target_conn
         
         src_conn = s
         target_conn = t
         
         target_conn.set_session(autocommit=True)
-        src_conn.set_session(readonly=True)
+        tune_session(target_conn)
+        if src_conn is not None:
+            src_conn.set_session(readonly=True)
         
-        # Truncate target db
-        truncate_tables()
-
+        init_journal()
+        FOREIGN_SOURCE = init_foreign_source() if src_conn is not None else False
+        DELTA = RUN_MODE == "delta"
+        RESUME = RUN_MODE == "resume" or RUN_MODE == "auto" and has_unfinished_run()
+        if DELTA:
+            if DUMP_MODE == "load":
+                raise ValueError("delta runs cannot be loaded from extracted files")
+            WATERMARKS = load_watermarks()
+            if not WATERMARKS:
+                raise ValueError("no high-water marks recorded, a full migration is required before a delta run")
+        if RESUME:
+            if is_finished("migration"):
+                print("previous migration is finished, nothing to resume (RUN_MODE=fresh starts over)")
+                return
+            check_bulk_load()
+        MARKS = source_watermarks() if src_conn is not None else manifest["marks"]
         start = time.time()
-        # Copy tables
-        for name in tables:
-            if tables[name] is not None:
-                print("processing {}".format(name))
-                tables[name](name)
+        try:
+            if DELTA:
+                print("synchronizing changes since previous migration")
+            elif RESUME:
+                print("resuming previous migration")
             else:
-                print("ignoring {}".format(name))
-                pass
-        # Update sequences
-        update_sequences()
-
-        # migrate trajectoryObservations
-        fixup_trajectory_observations()
+                # Truncate target db
+                with measure("phase", "truncate_tables"):
+                    truncate_tables()
+                # The high-water marks are recorded again once the run is finished, delta runs are refused until then
+                target_conn.cursor().execute("TRUNCATE TABLE migrator.journal, migrator.watermark")
+
+            if BULK_LOAD and not DELTA:
+                with measure("phase", "begin_bulk_load"):
+                    begin_bulk_load()
+
+            # Copy tables
+            run_plan(build_plan())
+
+            # Update sequences
+            with measure("phase", "update_sequences"):
+                update_sequences()
+
+            # migrate trajectoryObservations
+            with measure("phase", "fixup_trajectory_observations"):
+                fixup_trajectory_observations()
+            if DELTA:
+                with measure("phase", "link_dataset_observations"):
+                    link_dataset_observations()
+            if BULK_LOAD and not DELTA:
+                with measure("phase", "finish_bulk_load"):
+                    finish_bulk_load()
+            journal("migration")
+            record_watermarks(MARKS)
+
+            print("TIME:")
+            print(time.time() - start)
+        finally:
+            write_report(start)
+
+
+# Throughput assumed by `estimate` for stages without figures from a previous run: rows per second of table copies
+# and index builds, trajectory datasets per second
+PLAN_ROWS_PER_SECOND = 50_000
+PLAN_INDEX_ROWS_PER_SECOND = 500_000
+PLAN_DATASETS_PER_SECOND = 1_000
+
+
+# Estimates the stages of a migration of the source: rows and bytes from the source catalog, durations from the
+# throughput recorded in the `previous` report (see `write_report`), scaled to the configured WORKERS. Stages without
+# previous figures are estimated with the PLAN_* defaults. Returns (stage, rows, bytes, seconds, basis) tuples.
+def estimate(previous):
+    src_cursor = src_conn.cursor()
+    records = {(r["kind"], r["name"]): r for r in previous.get("phases", []) if r["kind"] != "chunk"}
+    tables_rows = sum(r["rows"] for r in records.values() if r["kind"] == "table")
+    tables_seconds = sum(r["seconds"] for r in records.values() if r["kind"] == "table")
+    speedup = WORKERS / previous.get("workers", 1)
+
+    def catalog(table):
+        src_cursor.execute("SELECT GREATEST(c.reltuples, 0)::bigint, pg_relation_size(c.oid), "
+                           "COALESCE(pg_total_relation_size(NULLIF(c.reltoastrelid, 0)), 0) "
+                           "FROM pg_class c WHERE c.oid = to_regclass(%s)", (table,))
+        row = src_cursor.fetchone()
+        return (row[0], row[1] + row[2]) if row is not None else (0, 0)
+
+    def duration(kind, name, rows, default_rate, scale=1.0):
+        record = records.get((kind, name))
+        if record is not None and record["rows_per_second"]:
+            return rows / record["rows_per_second"] / scale, "previous run"
+        if kind == "table" and tables_rows > 0 and tables_seconds > 0:
+            return rows / (tables_rows / tables_seconds) / scale, "previous run (all tables)"
+        return rows / default_rate / scale, "default"
+
+    # Rows driving the set-based steps of `copy_dataset` and `fixup_trajectory_observations`: all base datasets are
+    # migrated without discriminator and get a trajectory observation
+    src_cursor.execute("SELECT COUNT(*) FROM public.datastream")
+    datastreams = src_cursor.fetchone()[0]
+    src_cursor.execute("SELECT COUNT(*) FROM public.dataset")
+    datasets = src_cursor.fetchone()[0]
+
+    stages = []
+    total_rows = 0
+    for name in [name for name in tables if tables[name] is not None]:
+        rows, size = catalog(projections.get(name, {}).get("source", f"public.{name}").split()[0])
+        if name == "dataset":
+            rows, size = rows + datastreams, size + catalog("public.datastream")[1]
+        total_rows += rows
+        seconds, basis = duration("table", name, rows, PLAN_ROWS_PER_SECOND, speedup if name in chunking else 1.0)
+        stages.append((f"table {name}", rows, size, seconds, basis))
+        if chunking.get(name, {}).get("defer_ddl"):
+            record, table = records.get(("indices", name)), records.get(("table", name))
+            if record is not None and table is not None and table["rows"] > 0:
+                stages.append((f"indices {name}", rows, None, record["seconds"] * rows / table["rows"],
+                               "previous run"))
+            else:
+                stages.append((f"indices {name}", rows, None, rows / PLAN_INDEX_ROWS_PER_SECOND, "default"))
+
+    seconds, basis = duration("phase", "fixup_trajectory_observations", datasets, PLAN_DATASETS_PER_SECOND)
+    stages.append(("phase fixup_trajectory_observations", datasets, None, seconds, basis))
+
+    # Further phases of the previous run grow with the volume of the migration
+    for (kind, name), record in records.items():
+        if kind == "phase" and name != "fixup_trajectory_observations" and tables_rows > 0:
+            stages.append((f"phase {name}", None, None, record["seconds"] * total_rows / tables_rows, "previous run"))
+    return stages, datastreams, datasets
+
+
+# Prints the estimated plan of a migration of the source without touching the target. Throughput figures are taken
+# from the given report of a previous run (REPORT_FILE by default), if present.
+def plan_main(args):
+    global src_conn
+    configure_dsns()
+    configure()
+    report_file = args[0] if args else REPORT_FILE
+    previous = {}
+    if report_file and os.path.exists(report_file):
+        with open(report_file) as f:
+            previous = json.load(f)
+        print(f"using throughput of the run started {previous.get('started')} ({report_file})")
+    else:
+        print("no previous report, using default throughput")
+
+    with psycopg.connect(src_dsn) as src_conn:
+        src_conn.set_session(readonly=True)
+        stages, datastreams, datasets = estimate(previous)
+
+    print(f"{datastreams} datastreams become aggregations, {datasets} datasets get a trajectory observation")
+    print(f"{'stage':<45}{'rows':>14}{'MiB':>12}{'duration':>12}  basis")
+    for stage, rows, size, seconds, basis in stages:
+        print(f"{stage:<45}{rows if rows is not None else '-':>14}"
+              f"{f'{size / 2 ** 20:.1f}' if size is not None else '-':>12}"
+              f"{str(datetime.timedelta(seconds=round(seconds))):>12}  {basis}")
+    total = sum(stage[3] for stage in stages)
+    print(f"estimated duration: {datetime.timedelta(seconds=round(total))} with {WORKERS} workers")
+    if CONCURRENCY > 1:
+        # Independent tables overlap, the longest stage and the total work per process bound the duration
+        bound = max(max(stage[3] for stage in stages), total / CONCURRENCY)
+        print(f"with CONCURRENCY={CONCURRENCY}: at least {datetime.timedelta(seconds=round(bound))}")
+
+
+# Verifies the target against the source, optionally restricted to the given `tables` entries
+def verify_main(names):
+    global src_conn, target_conn
+    configure_dsns()
+    configure()
+    with psycopg.connect(src_dsn) as src_conn, psycopg.connect(target_dsn) as target_conn:
+        src_conn.set_session(readonly=True)
+        start = time.time()
+        matching = verify(names)
+        print(f"verification {'passed' if matching else 'FAILED'} in {time.time() - start:.1f}s")
+    return 0 if matching else 1
+
+
+# Extracts all `tables` entries from the source into chunk files in the mapped layout of the target and writes the
+# manifest describing them. Needs no target database.
+def extract_main(args):
+    global src_conn, target_conn, DUMP_MODE, DUMP_DIR, MARKS, dump_entry, dump_steps
+    configure_dsns()
+    configure()
+    DUMP_MODE = "extract"
+    DUMP_DIR = args[0] if args else DUMP_DIR
+    os.makedirs(DUMP_DIR, exist_ok=True)
+
+    with psycopg.connect(src_dsn) as src_conn:
+        src_conn.set_session(readonly=True)
+        target_conn = ManifestTarget()
+        MARKS = source_watermarks()
+        manifest.update({"extracted": datetime.datetime.now().isoformat(), "marks": MARKS, "entries": {}})
+        start = time.time()
+        try:
+            for name in [name for name in tables if tables[name] is not None]:
+                print(f"extracting {name}")
+                dump_entry = name
+                dump_steps = manifest["entries"][name] = []
+                with measure("table", name):
+                    tables[name](name)
+                write_manifest()
+            print(f"extracted into {DUMP_DIR} in {time.time() - start:.1f}s")
+        finally:
+            write_report(start)
+
+
+# Loads the target from the chunk files extracted into the given directory. Runs like a migration (RUN_MODE, resume,
+# WORKERS, ...) with the files in place of the source.
+def load_main(args):
+    global DUMP_MODE, DUMP_DIR, manifest
+    configure()
+    DUMP_DIR = args[0] if args else DUMP_DIR
+    # also seen by `configure` of the migration and its worker processes
+    os.environ["DUMP_DIR"] = DUMP_DIR
+    with open(os.path.join(DUMP_DIR, "manifest.json")) as f:
+        manifest = json.load(f)
+    DUMP_MODE = "load"
+    main()
 
-        print("TIME:")
-        print(time.time() - start)
 
+# usage: python main.py [migrate | plan [report] | verify [table ...] | extract [directory] | load [directory]]
+commands = {
+    "migrate": lambda args: main(),
+    "plan": plan_main,
+    "verify": verify_main,
+    "extract": extract_main,
+    "load": load_main,
+}
 
 if __name__ == '__main__':
-    main()
+    command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    if command not in commands:
+        sys.exit(f"unknown command: {command}, expected one of {', '.join(commands)}")
+    sys.exit(commands[command](sys.argv[2:]))